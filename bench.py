@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+import contextlib
+import io
+import json
+import optparse
+import os
+import re
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from corpus import make_corpus, make_note_tree
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+
+# 从知乎、简书公式链接里解出来的公式，'+' 是链接里编码的空格
+formula_corpus = [
+    r'\begin{aligned}+L(\theta)+&=+\sum_{i=1}^{N}+\log+p(y_i|x_i;\theta)+\\+&=+\sum_{i=1}^{N}+y_i+\log+\hat{y}_i+\end{aligned}',
+    r'f(x)+\approx+f(x^{(k)})+++\nabla+f(x^{(k)})^T+(x+-+x^{(k)})',
+    r'\mathbb{E}_{x+\sim+p(x)}+[\log+q(x)]+\leq+\log+\mathbb{E}_{x+\sim+p(x)}+[q(x)]',
+    r'\frac{\partial+L}{\partial+w_{ij}}+=+\delta_j+\cdot+o_i',
+    r'\sum_{k=1}^{K}+\pi_k+\mathcal{N}(x|\mu_k,+\Sigma_k)++\tag{1}',
+    r'p(y=1|x)+=+\frac{1}{1+++e^{-w^Tx}}',
+    r'\begin{cases}+x+\times+y,+&+x+>+0+\\+0,+&+\text{otherwise}+\end{cases}',
+    r'\Re(z)+\ne+0,+\quad+z+\in+\mathbb{C}',
+    r'\prod_{i=1}^{n}+P(x_i)+\Rightarrow+\log+L+=+\sum_i+\log+P(x_i)',
+    r'\hat{y}+=+\text{softmax}(W+\cdot+h+++b)',
+]
+
+formula_lines = [
+    '普通的中文文本，没有公式链接 some english [link](https://example.com)',
+    '![[公式]](https://www.zhihu.com/equation?tex=%5Cfrac%7B1%7D%7B2%7D+x%5E2) 和 ![x+y](https://math.jianshu.com/math?formula=x%2By)',
+    '![\\alpha_i](https://wikimedia.org/api/rest_v1/media/math/render/svg/0a1b2c) 中文 ![img](https://pic1.zhimg.com/80/a.png)',
+]
+
+tag_lines = [
+    '<img src="https://pic1.zhimg.com/80/0799b3d6e5e92245ee937db3c26d1b80_1440w.png" alt="img" style="zoom:33%;" />',
+    '<span style="border-bottom:2px red double">重点</span>内容<span style="color: red">✍</span>',
+    '<ruby>魑<rt>chī</rt></ruby><ruby>魅<rt>mèi</rt></ruby><ruby>魍<rt>wǎng</rt></ruby><ruby>魉<rt>liǎng</rt></ruby>',
+    '<center><img src="https://pic2.zhimg.com/v2-1.jpg" width="60%"/></center><br/><!-- 图1 -->',
+    '<p align="center"><b>表 1</b>：a < b 并且 c > d</p>',
+]
+
+
+def regular_code_loop(code, rules):
+    # 原来的实现：每轮执行全部规则，直到一轮下来不再变化
+    while True:
+        old = code
+        for _, _, pattern, repl in rules:
+            code = re.sub(pattern.pattern, repl, code)
+        if code == old:
+            return code
+
+
+def replace_tex_command_loop(line, tab):
+    # 原来的实现：逐个字符 takewhile，每个命令之后切片
+    from itertools import takewhile
+    acc = []
+    while line:
+        prefix = ''.join(takewhile(lambda x: x != '\\', line))
+        acc.append(prefix)
+        line = line[len(prefix):]
+        if not line:
+            return ''.join(acc)
+
+        cmd = ''.join(takewhile(lambda c: c in string.ascii_letters, line[1:]))
+        symbol = tab.get(cmd)
+        length = max(2, len(cmd) + 1)
+        acc.append(line[:length] if symbol is None else symbol)
+        line = line[length:]
+    return ''.join(acc)
+
+
+def measure(fn, *args, number=1000):
+    start = time.perf_counter()
+    for _ in range(number):
+        fn(*args)
+    return number / (time.perf_counter() - start)
+
+
+def peak_memory(fn, *args):
+    # 单独跑一次，记录期间 python 分配内存的峰值，单位 KB
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def quiet():
+    # 格式化过程中会打印调试信息，测量时丢掉
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def bench_regular_code(number):
+    from conv import code_rules, regular_code
+
+    def loop():
+        for code in formula_corpus:
+            regular_code_loop(code, code_rules.rules)
+
+    def compiled():
+        for code in formula_corpus:
+            regular_code(code)
+
+    for code in formula_corpus:
+        assert regular_code(code) == regular_code_loop(code, code_rules.rules)
+    return [
+        ('regular_code/loop', measure(loop, number=number)),
+        ('regular_code/compiled', measure(compiled, number=number)),
+    ]
+
+
+def bench_html_tag(number):
+    from htmls import _seek_html_tag_by_parser, seek_html_tag
+
+    tags = [line[i:] for line in tag_lines for i, c in enumerate(line) if c == '<']
+
+    def parser():
+        for t in tags:
+            _seek_html_tag_by_parser(t)
+
+    def scanner():
+        for t in tags:
+            seek_html_tag(t)
+
+    for t in tags:
+        assert seek_html_tag(t) == _seek_html_tag_by_parser(t)
+    return [
+        ('seek_html_tag/parser', measure(parser, number=number)),
+        ('seek_html_tag/scanner', measure(scanner, number=number)),
+    ]
+
+
+def bench_tex_command(number):
+    from tex import cmd2symbol, replace_tex_command
+
+    texts = [code.replace('+', ' ') for code in formula_corpus]
+    texts.append('设 $x \\in \\mathbb{R}^n$，$\\int_0^\\infty e^{-x} dx = 1$，且 $\\alpha \\leq \\beta \\cdots$ \\note')
+
+    def loop():
+        for t in texts:
+            replace_tex_command_loop(t, cmd2symbol)
+
+    def compiled():
+        for t in texts:
+            replace_tex_command(t)
+
+    for t in texts:
+        assert replace_tex_command(t) == replace_tex_command_loop(t, cmd2symbol)
+    return [
+        ('replace_tex_command/loop', measure(loop, number=number)),
+        ('replace_tex_command/compiled', measure(compiled, number=number)),
+    ]
+
+
+def bench_formula(number):
+    from conv import convert_to_latex_formula
+
+    def convert(lines):
+        for line in lines:
+            convert_to_latex_formula(line, False, False)
+
+    return [
+        ('convert_to_latex_formula/plain', measure(convert, formula_lines[:1], number=number * 10)),
+        ('convert_to_latex_formula/links', measure(convert, formula_lines[1:], number=number)),
+    ]
+
+
+def bench_strip_html(number):
+    from htmls import _strip_by_parser, strip_counters, strip_html_tags
+
+    lines = tag_lines + [
+        '普通的中文段落，没有任何标记，只是很长的一行文字 with some english words',
+        '- 列表项：$x+y$ 和 `code`',
+        'tags: AI, 深度学习',
+    ] * 3
+
+    def parser():
+        for line in lines:
+            _strip_by_parser(line)
+
+    def fast():
+        for line in lines:
+            strip_html_tags(line)
+
+    for line in lines:
+        assert strip_html_tags(line) == _strip_by_parser(line)
+    strip_counters.clear()
+    result = [
+        ('strip_html_tags/parser', measure(parser, number=number)),
+        ('strip_html_tags/fast', measure(fast, number=number)),
+    ]
+    total = sum(strip_counters.values())
+    for k, v in sorted(strip_counters.items()):
+        print(f"strip_html_tags {k}: {v / total:.0%}")
+    return result
+
+
+def os_walk_latest(directory):
+    # 原来 tags.py 的遍历方式：os.walk 加上每个文件单独的 islink/getmtime/abspath
+    from tags import abspath, is_broken_link
+
+    latest_file, latest_mtime = None, 0
+    for root, sub_dirs, files in os.walk(directory):
+        for file in files:
+            if not file.endswith('.md'):
+                continue
+            path = abspath(root, file)
+            if os.path.islink(path):
+                is_broken_link(path)
+                continue
+            mtime = os.path.getmtime(path)
+            if mtime > latest_mtime:
+                latest_file, latest_mtime = path, mtime
+    return latest_file
+
+
+def bench_walk(number):
+    from index import NoteIndex
+    from tags import find_the_latest_modified_markdown_file
+
+    root = tempfile.mkdtemp()
+    try:
+        make_note_tree(root)
+        number = max(1, number // 20)
+        refresh = lambda: NoteIndex(root).refresh().save()
+        return [
+            ('walk/os.walk', measure(os_walk_latest, root, number=number)),
+            ('walk/scandir', measure(find_the_latest_modified_markdown_file, root, number=number),
+             peak_memory(find_the_latest_modified_markdown_file, root)),
+            ('walk/scandir-serial', measure(find_the_latest_modified_markdown_file, root, 1, number=number)),
+            ('walk/index-refresh', measure(refresh, number=number), peak_memory(refresh)),
+        ]
+    finally:
+        shutil.rmtree(root)
+
+
+def bench_stages(number, corpus=None):
+    # 在生成的笔记上分别测量各个阶段，每个阶段同时记录内存峰值
+    from conv import convert_to_latex_formula, regular_code
+    from fmt import format_content
+    from md import parse_to_lines
+    from seg import parse_to_segs
+    from tex import replace_tex_command
+
+    docs = corpus if corpus is not None else make_corpus()
+    lines = [line for doc in docs for line in doc.split('\n')]
+    with quiet():
+        parsed = [list(parse_to_lines(doc)) for doc in docs]
+    texts = [line.text for doc in parsed for line in doc]
+    codes = [code.replace('+', ' ') for code in formula_corpus]
+    number = max(1, number // 20)
+
+    def stage_parse_to_lines():
+        for doc in docs:
+            list(parse_to_lines(doc))
+
+    def stage_parse_to_segs():
+        for text in texts:
+            list(parse_to_segs(text))
+
+    def stage_format_content():
+        for doc in docs:
+            format_content(list(parse_to_lines(doc)))
+
+    def stage_convert():
+        for line in lines:
+            convert_to_latex_formula(line, False, False)
+
+    def stage_regular_code():
+        for code in formula_corpus:
+            regular_code(code)
+
+    def stage_tex_command():
+        for code in codes:
+            replace_tex_command(code)
+
+    stages = [
+        ('stage/parse_to_lines', stage_parse_to_lines, number),
+        ('stage/parse_to_segs', stage_parse_to_segs, number),
+        ('stage/format_content', stage_format_content, number),
+        ('stage/convert_to_latex_formula', stage_convert, number),
+        ('stage/regular_code', stage_regular_code, number * 20),
+        ('stage/replace_tex_command', stage_tex_command, number * 20),
+    ]
+    result = []
+    with quiet():
+        for label, fn, n in stages:
+            result.append((label, measure(fn, number=n), peak_memory(fn)))
+    return result
+
+
+def bench_incremental(number, n_lines=3000):
+    # 一篇长笔记改了一行之后重新格式化：不带缓存和带着上一次的 LineMemo
+    from corpus import make_markdown
+    from fmt import LineMemo, format_text
+
+    doc = make_markdown('zhihu', n_lines, seed=3)
+    lines = doc.split('\n')
+    edits = []
+    for i in range(8):
+        edited = list(lines)
+        edited[(i * 997) % n_lines] += f' 改动{i}'
+        edits.append('\n'.join(edited))
+
+    memo = LineMemo()
+    number = max(1, number // 40)
+    with quiet():
+        format_text(doc, True, memo=memo)
+        assert all(format_text(e, True, memo=memo) == format_text(e, True) for e in edits)
+        return [
+            ('incremental/cold', measure(lambda: [format_text(e, True) for e in edits], number=number)),
+            ('incremental/memo', measure(lambda: [format_text(e, True, memo=memo) for e in edits], number=number)),
+        ]
+
+
+def bench_chunked(number, n_lines=60000):
+    # 一篇很大的导出文件：顺序格式化和切块后在 CPU 个数的进程里格式化
+    from corpus import make_markdown
+    from fmt import format_text
+
+    doc = '\n'.join(make_markdown(style, n_lines // 3, seed=i) for i, style in enumerate(('zhihu', 'jianshu', 'wiki')))
+    jobs = os.cpu_count() or 1
+    number = max(1, number // 200)
+    with quiet():
+        assert format_text(doc, True, jobs=max(jobs, 2)) == format_text(doc, True)
+        return [
+            ('chunked/sequential', measure(format_text, doc, True, number=number)),
+            (f'chunked/jobs={jobs}', measure(lambda: format_text(doc, True, jobs=jobs), number=number)),
+        ]
+
+
+# 冷启动的时间上限（毫秒），编辑器每次保存都会启动一次 fmt.py
+startup_budget = {
+    'startup/import-fmt': 40,
+    'startup/help': 150,
+    'startup/format': 300,
+}
+
+
+def import_time(module):
+    # 用 -X importtime 在新进程里测 import 的累计耗时，单位秒
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                         capture_output=True, text=True, cwd=src_dir).stderr
+    for line in out.splitlines():
+        _, cumulative, name = line.split('|')
+        if name.strip() == module and not name.startswith('  '):
+            return int(cumulative) / 1e6
+    raise ValueError(f"no import time for {module}")
+
+
+def cold_run(args, stdin=None, number=5):
+    # 多次启动新进程取最快的一次，单位秒
+    best = None
+    for _ in range(number):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], input=stdin, stdout=subprocess.DEVNULL, cwd=src_dir,
+                       check=True, text=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_startup(number):
+    # 冷启动：fmt 的 import 耗时、fmt.py --help 和格式化一篇笔记的总时间
+    number = max(3, number // 40)
+    doc = make_corpus(1)[0]
+    seconds = [
+        ('startup/python', cold_run(['-c', 'pass'], number=number)),
+        ('startup/import-fmt', min(import_time('fmt') for _ in range(number))),
+        ('startup/help', cold_run(['fmt.py', '--help'], number=number)),
+        ('startup/format', cold_run(['fmt.py', '--filter'], stdin=doc, number=number)),
+    ]
+    return [(label, 1 / t, None) for label, t in seconds]
+
+
+def over_budget(rows):
+    return [f"{label}: {1000 / ops:.1f}ms > {startup_budget[label]}ms budget"
+            for label, ops, _ in rows if label in startup_budget and 1000 / ops > startup_budget[label]]
+
+
+def load_baseline(path):
+    # 基准和机器有关，不放进仓库：在参考机器上先跑一遍 bench.py --save-baseline 生成
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        print(f"no baseline at {path}, regressions are not checked; "
+              f"run `bench.py --save-baseline` first to create one", file=sys.stderr)
+    except (OSError, ValueError) as e:
+        print(f"can not read baseline {path}: {e}, regressions are not checked", file=sys.stderr)
+    return {}
+
+
+def save_baseline(path, rows):
+    with open(path, 'w') as f:
+        json.dump({label: {'ops': ops, 'peak_kb': peak} for label, ops, peak in rows}, f, indent=2, sort_keys=True)
+
+
+def compare(rows, baseline, threshold):
+    # 和保存的基准比较，ops/sec 下降或内存峰值上升超过 threshold 的算退化
+    regressions = []
+    for label, ops, peak in rows:
+        base = baseline.get(label)
+        if not base:
+            continue
+        if ops < base['ops'] * (1 - threshold):
+            regressions.append(f"{label}: {base['ops']:.1f} -> {ops:.1f} ops/sec")
+        if peak is not None and base.get('peak_kb') and peak > base['peak_kb'] * (1 + threshold):
+            regressions.append(f"{label}: {base['peak_kb']:.0f} -> {peak:.0f} KB peak")
+    return regressions
+
+
+benches = {
+    'regular_code': bench_regular_code,
+    'html_tag': bench_html_tag,
+    'formula': bench_formula,
+    'tex_command': bench_tex_command,
+    'strip_html': bench_strip_html,
+    'walk': bench_walk,
+    'stages': bench_stages,
+    'startup': bench_startup,
+    'incremental': bench_incremental,
+    'chunked': bench_chunked,
+}
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [bench...]")
+    parser.add_option('-n', '--number', dest="number", help="iterations per bench", type="int", default=200)
+    parser.add_option('-b', '--baseline', dest="baseline", help="baseline json to compare with",
+                      default=os.path.join(src_dir, '.bench-baseline.json'))
+    parser.add_option('', '--save-baseline', dest="save", help="save results as the new baseline",
+                      action="store_true", default=False)
+    parser.add_option('', '--threshold', dest="threshold", help="allowed slowdown before reporting a regression",
+                      type="float", default=0.2)
+    (options, args) = parser.parse_args()
+
+    baseline = {} if options.save else load_baseline(options.baseline)
+    rows = []
+    for name in args or benches:
+        for row in benches[name](options.number):
+            label, ops, peak = row if len(row) == 3 else (*row, None)
+            rows.append((label, ops, peak))
+            base = baseline.get(label)
+            change = f"{ops / base['ops']:>7.2f}x" if base else ''
+            mem = f"{peak:>10.0f} KB" if peak is not None else ' ' * 13
+            print(f"{label:<40} {ops:>12.1f} ops/sec {mem} {change}")
+
+    if options.save:
+        save_baseline(options.baseline, rows)
+        print(f"baseline saved to {options.baseline}")
+        return
+    regressions = compare(rows, baseline, options.threshold) + over_budget(rows)
+    for r in regressions:
+        print(f"regression {r}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
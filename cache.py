@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+
+_version = 1
+# 决定格式化结果的模块，任何一个改动都会让缓存整体失效
+_rule_modules = ('md', 'conv', 'tex', 'htmls', 'seg', 'matcher', 'rewrite', 'fmt')
+
+
+def content_hash(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def file_hash(path, chunk_size=1 << 16):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def rules_version(*options):
+    h = hashlib.sha1(repr(options).encode('utf-8'))
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in _rule_modules:
+        try:
+            with open(os.path.join(src_dir, f'{name}.py'), 'rb') as f:
+                h.update(f.read())
+        except OSError:
+            h.update(name.encode('utf-8'))
+    return h.hexdigest()
+
+
+class FormatCache:
+    # 记录每个文件上次写出内容的 hash 和当时的规则版本；
+    # 文件当前内容的 hash 和上次写出的一致时说明已经格式化过，不用再解析
+    def __init__(self, path, rules):
+        self.path = os.path.expanduser(path)
+        self.rules = rules
+        self.files = {}
+        self._changed = False
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return self
+        if isinstance(data, dict) and data.get('version') == _version:
+            self.files = data.get('files', {})
+        return self
+
+    def save(self):
+        if not self._changed:
+            return self
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'version': _version, 'files': self.files}, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+            self._changed = False
+        except OSError:
+            pass
+        return self
+
+    def is_fresh(self, path):
+        entry = self.files.get(os.path.abspath(path))
+        if entry is None or entry['rules'] != self.rules:
+            return False
+        try:
+            return file_hash(path) == entry['hash']
+        except OSError:
+            return False
+
+    def record(self, path, digest):
+        entry = {'hash': digest, 'rules': self.rules}
+        path = os.path.abspath(path)
+        if self.files.get(path) != entry:
+            self.files[path] = entry
+            self._changed = True
+
+    def forget(self, path):
+        if self.files.pop(os.path.abspath(path), None) is not None:
+            self._changed = True
+
+    def __repr__(self):
+        return f"FormatCache(path={self.path}, files={len(self.files)})"
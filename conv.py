@@ -1,11 +1,12 @@
 import re
 from urllib.parse import unquote
 
+from rewrite import FixpointRewriter, LazyPattern
+
 
 def add_head_tail(code, use_block=False):
     use_block = use_block or ('\n' in code or '\\\\' in code or "\\tag" in code or '&' in code)
     if use_block:
-        print('use block =============================')
         if 'begin' not in code:
             code = '\\begin{align}\n' + code + "\n\n\\end{align}"
         return f'\n$$\n{code}\n$$\n'
@@ -13,163 +14,196 @@ def add_head_tail(code, use_block=False):
         return f'${code}$'
 
 
-def regular_code(code):
-    no_plus_in_right = [
-        "times", "cdot", "nonumber",
-        "gt", "in", "ne", "lt", "geq", "leq",
-        "cap", "sim", "mid",
-        "Leftarrow", "Rightarrow", "Leftrightarrow",
-        "log", "exp", "partial", "sum", "prod", 'ln',
-        "text", "texttt", "boldsymbol", "frac", "sqrt",
-        "approx", '=', ',', '-', '_',
-    ]
-
-    no_plus_in_left = [
-        "times", "cdot", "nonumber",
-        "gt", "in", "ne", "lt", "geq", "leq",
-        "cap", "sim", 'right', 'mid',
-        "Leftarrow", "Rightarrow", "Leftrightarrow",
-        "tag", "approx", '=', '_', '-', '^',
-    ]
-
-    while True:
-        old = code
-        code = re.sub(r'(\\begin{(align|aligned|align\*|cases)})\++', r'\1\n', code)
-        code = re.sub(r'\++\\end{', r'\n\\end{', code)
-
-        code = re.sub(r'^\+', '', code)
-        code = re.sub(r'\+$', '', code)
-        code = re.sub(r'\+}', '}', code)
-        code = re.sub(r'\+{', '{', code)
-        code = re.sub(r'(\\[a-zA-Z]+)\+', '\\1 ', code)
-        code = re.sub(r'\\\+', '\\ ', code)
-        code = re.sub(r'\\\\\s*\\tag', r' \\tag', code)
-
-        # fix it
-        # code = re.sub(r'\+', ' ', code)
-
-        code = re.sub(r'\|\++', '|', code)
-        code = re.sub(r'\++\|', '|', code)
-        code = re.sub(r'-\++', '-', code)
-        code = re.sub(r'\++-', '-', code)
-        code = re.sub(r',\++', ',', code)
-        code = re.sub(r'\++=', '=', code)
-        code = re.sub(r'=\++', '=', code)
-        code = re.sub(r'\++,', ',', code)
-        code = re.sub(r'\(\++', '(', code)
-        code = re.sub(r'\++\)', ')', code)
-
-        code = re.sub(r'\+;', ';', code)
-        code = re.sub(r';\+', ';', code)
+_no_plus_in_right = [
+    "times", "cdot", "nonumber",
+    "gt", "in", "ne", "lt", "geq", "leq",
+    "cap", "sim", "mid",
+    "Leftarrow", "Rightarrow", "Leftrightarrow",
+    "log", "exp", "partial", "sum", "prod", 'ln',
+    "text", "texttt", "boldsymbol", "frac", "sqrt",
+    "approx", '=', ',', '-', '_',
+]
+
+_no_plus_in_left = [
+    "times", "cdot", "nonumber",
+    "gt", "in", "ne", "lt", "geq", "leq",
+    "cap", "sim", 'right', 'mid',
+    "Leftarrow", "Rightarrow", "Leftrightarrow",
+    "tag", "approx", '=', '_', '-', '^',
+]
+
+# regular_code 的规则表，按顺序执行直到不再变化，第二列是规则能命中时必须出现的字面量
+code_rules = FixpointRewriter(
+    ('begin-plus', ('\\begin{', '+'), r'(\\begin{(align|aligned|align\*|cases)})\++', r'\1\n'),
+    ('plus-end', ('\\end{', '+'), r'\++\\end{', r'\n\\end{'),
+
+    ('leading-plus', '+', r'^\+', ''),
+    ('trailing-plus', '+', r'\+$', ''),
+    ('plus-rbrace', '+}', r'\+}', '}'),
+    ('plus-lbrace', '+{', r'\+{', '{'),
+    ('command-plus', ('\\', '+'), r'(\\[a-zA-Z]+)\+', '\\1 '),
+    ('escaped-plus', '\\+', r'\\\+', '\\ '),
+    ('newline-tag', ('\\\\', '\\tag'), r'\\\\\s*\\tag', r' \\tag'),
+
+    # fix it
+    # ('plus', '+', r'\+', ' '),
+
+    ('bar-plus', '|+', r'\|\++', '|'),
+    ('plus-bar', '+|', r'\++\|', '|'),
+    ('minus-plus', '-+', r'-\++', '-'),
+    ('plus-minus', '+-', r'\++-', '-'),
+    ('comma-plus', ',+', r',\++', ','),
+    ('plus-eq', '+=', r'\++=', '='),
+    ('eq-plus', '=+', r'=\++', '='),
+    ('plus-comma', '+,', r'\++,', ','),
+    ('lparen-plus', '(+', r'\(\++', '('),
+    ('plus-rparen', '+)', r'\++\)', ')'),
+
+    ('plus-semicolon', '+;', r'\+;', ';'),
+    ('semicolon-plus', ';+', r';\+', ';'),
+
+    ('plus-amp', ('+', '&'), r'\++\s?&', r'\n&'),
+    ('amp-plus', '&+', r'&\++', r'& '),
+
+    ('plus-run-to-space', '++', r'\+{2,}', r' '),
+
+    ('plus-left-command', '+\\', f'\\++\\\\({"|".join(_no_plus_in_left)})', r' \\\1'),
+    ('right-command-plus', ('\\', '+'), f'\\\\({"|".join(_no_plus_in_right)})\\++', r'\\\1 '),
+
+    ('plus-minus-once', '+-', r'\+-', r'-'),
+    ('plus-caret', '+^', r'\+\^', r'^'),
+    ('plus-run', '++', r'\+{2,}', r''),
+    ('escaped-plus-run', '\\+\\+', r'(\\\+){2,}', r''),
+
+    ('re-to-mathfrak', '\\Re', r'\\Re', r'\\mathfrak{R}'),
+
+    ('plus-newline', '+\\\\', r'\+\\\\', r' \\\\'),
+    ('newline-plus', '\\\\+', r'\\\\\++', r'\\\\\n'),
+
+    ('sum-prod-plus', '}+', r'(\\(sum|prod)_{[^}]+}\^{[^}]+})\++', r"\1"),
+)
 
-        code = re.sub(r'\++\s?&', r'\n&', code)
-        code = re.sub(r'&\++', r'& ', code)
 
-        code = re.sub(r'\+{2,}', r' ', code)
-
-        code = re.sub(f'\\++\\\\({"|".join(no_plus_in_left)})', r' \\\1', code)
-        code = re.sub(f'\\\\({"|".join(no_plus_in_right)})\\++', r'\\\1 ', code)
-
-        code = re.sub(r'\+-', r'-', code)
-        code = re.sub(r'\+\^', r'^', code)
-        code = re.sub(r'\+{2,}', r'', code)
-        code = re.sub(r'(\\\+){2,}', r'', code)
-
-        code = re.sub(r'\\Re', r'\\mathfrak{R}', code)
-
-        code = re.sub(r'\+\\\\', r' \\\\', code)
-        code = re.sub(r'\\\\\++', r'\\\\\n', code)
-
-        code = re.sub(r'(\\(sum|prod)_{[^}]+}\^{[^}]+})\++', r"\1", code)
-
-        if code == old:
-            return code
+def regular_code(code):
+    return code_rules.sub(code)
 
 
 def convert_to_latex_formula(line, remove_plus, keep_graph):
-    line = _convert_to_latex_formula(line, next_formula_zhihu, remove_plus, keep_graph)
-    line = _convert_to_latex_formula(line, next_formula_jianshu, remove_plus, keep_graph)
-    line = _convert_to_latex_formula(line, next_formula_wiki, remove_plus, keep_graph)
-    line = _convert_to_latex_formula(line, next_formula_github, remove_plus, keep_graph)
-    return line
+    if '](https://' not in line:
+        return line
 
-
-def _convert_to_latex_formula(line, code_extractor, remove_plus, keep_graph=False):
     acc = []
-    while True:
-        res = code_extractor(line)
-        if not res:
-            # 在这行没有找到任何需要处理的公示，直接返回，不要再格式化，防止格式化错误
-            if not acc and line:
-                return line
-            if line:
-                acc.append((line, "text"))
-            break
-
+    pos = 0
+    for start, end, code in formula_providers.finditer(line):
         # 在这行找到了个链接公式，格式化
-        matched_text, code = res
-        assert len(matched_text) > 0
-        index = line.index(matched_text)
-        prev = line[:index]
-        if prev:
-            acc.append((prev, "text"))
+        if start > pos:
+            acc.append((line[pos:start], "text"))
 
         fmt_code = regular_code(code)
         if remove_plus:
-            fmt_code = re.sub(r'\+', ' ', fmt_code)
+            fmt_code = fmt_code.replace('+', ' ')
         acc.append((fmt_code, "formula"))
         if keep_graph and '+' in code:
-            acc.append((f"\n\n{matched_text}\n", "text"))
-        line = line[index + len(matched_text):]
+            acc.append((f"\n\n{line[start:end]}\n", "text"))
+        pos = end
+
+    if not acc:
+        # 在这行没有找到任何需要处理的公示，直接返回，不要再格式化，防止格式化错误
+        return line
+    if pos < len(line):
+        acc.append((line[pos:], "text"))
 
     if len(acc) == 1 and acc[0][1] == "formula":
         return add_head_tail(acc[0][0], use_block=True)
     return ''.join(s if t == "text" else add_head_tail(s) for s, t in acc)
 
 
-def next_formula_zhihu(line):
-    pattern = re.compile(r'!\[\[公式]]\(https://www\.zhihu\.com/equation\?tex=([^)]*)\)')
-    m = pattern.search(line)
-    if not m:
+class FormulaProviders:
+    # 公式图片链接的提供方注册表。所有提供方的正则合成一个，一行只扫描一遍；
+    # 新的提供方（比如 codecogs）用 register 加进来，不用再多扫一遍。
+    def __init__(self):
+        self.providers = []
+        self._pattern = None
+        self._group2index = {}
+
+    def register(self, name, pattern, to_code):
+        # to_code(m) 从提供方正则的匹配结果里取出公式，返回 None 表示这个链接不是公式
+        self.providers.append((name, LazyPattern(pattern), to_code))
+        self._pattern = None
+        return self
+
+    def compile(self):
+        if self._pattern is None:
+            self._pattern = re.compile('|'.join(f'(?P<_{i}>{p.pattern})' for i, (_, p, _) in enumerate(self.providers)))
+            self._group2index = {self._pattern.groupindex[f'_{i}']: i for i in range(len(self.providers))}
+        return self._pattern
+
+    def finditer(self, line):
+        # 按顺序产出 (start, end, code)
+        pattern = self.compile()
+        pos = 0
+        while True:
+            m = pattern.search(line, pos)
+            if not m:
+                return
+            start = m.start()
+            found = self._to_code(line, start, self._group2index[m.lastindex])
+            if found is None:
+                pos = start + 1
+                continue
+            end, code = found
+            yield start, end, code
+            pos = end if end > start else start + 1
+
+    def _to_code(self, line, start, first):
+        # 同一个位置可能有多个提供方能匹配，按注册顺序取第一个给出公式的
+        for _, p, to_code in self.providers[first:]:
+            m = p.match(line, start)
+            if not m:
+                continue
+            code = to_code(m)
+            if code is not None:
+                return m.end(), code
         return None
-    tex_encode = m.group(1)
-    tex_encode = re.sub(r'\+', '%20', tex_encode)
-    code = unquote(tex_encode)
-    return m.group(0), code
 
+    def __repr__(self):
+        return f"FormulaProviders({','.join(name for name, _, _ in self.providers)})"
 
-def next_formula_jianshu(line):
-    pattern = re.compile(r'!\[(.+?)]\(https://math.jianshu.com/math\?formula=([-*~._()%\da-zA-Z]*)\)')
-    m = pattern.search(line)
-    if not m:
-        return None
+
+_blank = re.compile(r'\s')
+# 图片的描述不能跨过 "](" 延伸到前面别的链接里
+_alt = r'((?:(?!\]\().)+?)'
+
+
+def formula_zhihu(m):
+    return unquote(m.group(1).replace('+', '%20'))
+
+
+def formula_jianshu(m):
     desc = m.group(1)
     url_code = unquote(m.group(2))
-    if re.sub(r'\s', '', desc) != re.sub(r'\s', '', url_code):
+    if _blank.sub('', desc) != _blank.sub('', url_code):
         return None
-    return m.group(0), url_code
+    return url_code
 
 
-def next_formula_github(line):
-    pattern = re.compile(
-        r'!\[(.+?)\]\(https://render.githubusercontent.com/render/math\?math=[-*~._()%\da-zA-Z]+&mode=inline')
-    m = pattern.search(line)
-    if not m:
-        return None
-    desc = m.group(1)
-    return m.group(0), desc.strip('$')
+def formula_github(m):
+    return m.group(1).strip('$')
 
 
-def next_formula_wiki(line):
-    pattern = re.compile(r'!\[(.+?)]\(https://wikimedia.org/api/rest_v1/media/math/render/svg/[0-9a-f]+\)')
-    m = pattern.search(line)
-    if not m:
-        return None
-    tex_code = m.group(1)
-    return m.group(0), tex_code
+def formula_wiki(m):
+    return m.group(1)
+
+
+formula_providers = FormulaProviders() \
+    .register('zhihu', r'!\[\[公式]]\(https://www\.zhihu\.com/equation\?tex=([^)]*)\)', formula_zhihu) \
+    .register('jianshu', rf'!\[{_alt}]\(https://math.jianshu.com/math\?formula=([-*~._()%\da-zA-Z]*)\)', formula_jianshu) \
+    .register('wiki', rf'!\[{_alt}]\(https://wikimedia.org/api/rest_v1/media/math/render/svg/[0-9a-f]+\)', formula_wiki) \
+    .register('github', rf'!\[{_alt}\]\(https://render.githubusercontent.com/render/math\?math=[-*~._()%\da-zA-Z]+&mode=inline',
+              formula_github)
 
 
-_useless_zhihu_link = re.compile(r'\[([^]]+)]\(https://www.zhihu.com/search\?q=.*?search_source.*?\)')
+_useless_zhihu_link = re.compile(r'\[([^]]+)]\(https://www\.zhihu\.com/search\?q=.*?search_source.*?\)')
 
 
 def remove_useless_links(text):
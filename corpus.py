@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import optparse
+import os
+import random
+from urllib.parse import quote
+
+# 生成用于基准测试的 markdown 文本和笔记目录树，同样的参数和 seed 总是生成同样的内容
+
+styles = ('zhihu', 'jianshu', 'wiki')
+
+_formulas = [
+    r'\frac{\partial L}{\partial w_{ij}} = \delta_j \cdot o_i',
+    r'p(y=1|x) = \frac{1}{1 + e^{-w^Tx}}',
+    r'\sum_{k=1}^{K} \pi_k \mathcal{N}(x|\mu_k, \Sigma_k)',
+    r'\mathbb{E}_{x \sim p(x)} [\log q(x)] \leq \log \mathbb{E}_{x \sim p(x)} [q(x)]',
+    r'\hat{y} = \text{softmax}(W \cdot h + b)',
+    r'x \in \mathbb{R}^n, \alpha \geq 0',
+    r'\int_0^\infty e^{-x} dx = 1',
+    r'\begin{aligned} L(\theta) &= \sum_{i=1}^{N} \log p(y_i|x_i;\theta) \\ &= \sum_i y_i \log \hat{y}_i \end{aligned}',
+    r'\theta^{(k+1)} = \theta^{(k)} - \eta \nabla f(\theta^{(k)})',
+    r'a_i',
+]
+
+_cjk_words = ['模型', '训练', '损失函数', '梯度', '优化', '参数', '样本', '分布', '概率', '推荐系统', '注意力机制', '特征',
+              '因此', '我们', '可以', '得到', '其中', '表示', '一个', '的', '是', '在', '和', '，', '。']
+_en_words = ['model', 'loss', 'gradient', 'the', 'of', 'and', 'softmax', 'embedding', 'batch', 'layer', 'is', 'a']
+_titles = ['背景', '模型结构', '损失函数', '实验', '参考文献', 'Introduction', '训练细节', '总结']
+_tags = ['AI', '深度学习', '推荐系统', '优化器', 'attention', '信息论']
+
+
+def _hex(rnd, n):
+    return ''.join(rnd.choice('0123456789abcdef') for _ in range(n))
+
+
+def _formula_link(rnd, style, tex):
+    if style == 'zhihu':
+        return f'![[公式]](https://www.zhihu.com/equation?tex={quote(tex, safe="")})'
+    if style == 'jianshu':
+        return f'![{tex}](https://math.jianshu.com/math?formula={quote(tex, safe="")})'
+    return f'![{{\\displaystyle {tex}}}](https://wikimedia.org/api/rest_v1/media/math/render/svg/{_hex(rnd, 40)})'
+
+
+def _image(rnd, style):
+    if style == 'zhihu':
+        return f'![img](https://pic{rnd.randint(1, 4)}.zhimg.com/80/v2-{_hex(rnd, 32)}_1440w.jpg)'
+    if style == 'jianshu':
+        return f'![image.png](https://upload-images.jianshu.io/upload_images/{rnd.randint(10 ** 6, 10 ** 7)}-{_hex(rnd, 16)}.png)'
+    return f'![](https://upload.wikimedia.org/wikipedia/commons/{_hex(rnd, 1)}/{_hex(rnd, 2)}/Figure_{rnd.randint(1, 99)}.svg)'
+
+
+def _link(rnd, style):
+    word = rnd.choice(_cjk_words[:12] + _en_words[:8])
+    if style == 'zhihu':
+        if rnd.random() < 0.5:
+            return f'[{word}](https://www.zhihu.com/search?q={quote(word)}&search_source=Entity&hybrid_search_source=Entity)'
+        return f'[{word}](https://link.zhihu.com/?target=https%3A//example.com/{_hex(rnd, 8)})'
+    if style == 'jianshu':
+        return f'[{word}](https://www.jianshu.com/p/{_hex(rnd, 12)})'
+    return f'[{word}](https://en.wikipedia.org/wiki/{quote(word)})'
+
+
+def _sentence(rnd, style, formula, link, cjk):
+    words = []
+    for _ in range(rnd.randint(6, 24)):
+        p = rnd.random()
+        if p < formula:
+            tex = rnd.choice(_formulas)
+            words.append(_formula_link(rnd, style, tex) if rnd.random() < 0.7 else f'${tex}$')
+        elif p < formula + link:
+            words.append(_link(rnd, style))
+        elif rnd.random() < cjk:
+            words.append(rnd.choice(_cjk_words))
+        else:
+            words.append(' ' + rnd.choice(_en_words) + ' ')
+    return ''.join(words)
+
+
+def make_markdown(style='zhihu', n_lines=200, formula=0.1, link=0.05, image=0.05, cjk=0.7, seed=0):
+    # 生成一篇某种来源风格的笔记：标签行、标题、段落、图片、代码块和公式块，密度是每个词/每行的概率
+    assert style in styles, style
+    rnd = random.Random(f'{style}:{seed}')
+    lines = [f'tags: {", ".join(rnd.sample(_tags, 2))}', '', f'# {rnd.choice(_titles)}']
+    while len(lines) < n_lines:
+        p = rnd.random()
+        if p < 0.08:
+            lines.append('#' * rnd.randint(2, 4) + ' ' + rnd.choice(_titles))
+        elif p < 0.08 + image:
+            lines.append(_image(rnd, style))
+        elif p < 0.16 + image:
+            lines.extend(['```python', 'for x in batch:', '    loss = model(x)', '```'])
+        elif p < 0.16 + image + formula / 2:
+            lines.extend(['$$', rnd.choice(_formulas), '$$'])
+        else:
+            lines.append(_sentence(rnd, style, formula, link, cjk))
+        lines.append('')
+    return '\n'.join(lines[:n_lines])
+
+
+def make_corpus(n_docs=30, n_lines=200, seed=0, **densities):
+    # 三种风格轮流，每篇的 seed 不同
+    return [make_markdown(styles[i % len(styles)], n_lines, seed=seed * 100003 + i, **densities)
+            for i in range(n_docs)]
+
+
+def make_note_tree(root, n_dirs=200, files_per_dir=30, links_per_dir=3, n_lines=0, seed=0):
+    # 生成一个笔记目录树：两层目录，每个目录若干 markdown 文件和指向其他目录文件的符号链接，
+    # n_lines > 0 时文件内容是生成的笔记，否则只有一个标题
+    paths = []
+    for i in range(n_dirs):
+        d = os.path.join(root, f'topic{i // 20}', f'tag{i}')
+        os.makedirs(d, exist_ok=True)
+        for j in range(files_per_dir):
+            path = os.path.join(d, f'note{i}_{j}.md')
+            with open(path, 'w') as f:
+                if n_lines > 0:
+                    f.write(make_markdown(styles[j % len(styles)], n_lines, seed=seed * 100003 + i * files_per_dir + j))
+                else:
+                    f.write('# note\n')
+            paths.append(path)
+        for j in range(min(links_per_dir, len(paths))):
+            os.symlink(paths[(i * 7 + j) % len(paths)], os.path.join(d, f'link{i}_{j}.md'))
+    return paths
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-s', '--style', dest="style", help="zhihu, jianshu or wiki", default='zhihu')
+    parser.add_option('-n', '--lines', dest="lines", help="lines per note", type="int", default=200)
+    parser.add_option('', '--seed', dest="seed", help="random seed", type="int", default=0)
+    parser.add_option('', '--formula', dest="formula", help="formula density", type="float", default=0.1)
+    parser.add_option('', '--link', dest="link", help="link density", type="float", default=0.05)
+    parser.add_option('', '--image', dest="image", help="image density", type="float", default=0.05)
+    parser.add_option('', '--cjk', dest="cjk", help="cjk density", type="float", default=0.7)
+    parser.add_option('', '--tree', dest="tree", help="write a note tree to this directory", default=None)
+    parser.add_option('', '--dirs', dest="dirs", help="directories in the note tree", type="int", default=200)
+    parser.add_option('', '--files', dest="files", help="files per directory", type="int", default=30)
+    (options, args) = parser.parse_args()
+
+    if options.tree:
+        paths = make_note_tree(options.tree, options.dirs, options.files, n_lines=options.lines, seed=options.seed)
+        print(f"{len(paths)} notes in {options.tree}")
+        return
+    print(make_markdown(options.style, options.lines, options.formula, options.link, options.image,
+                        options.cjk, options.seed))
+
+
+if __name__ == '__main__':
+    main()
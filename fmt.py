@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
+import glob
 import optparse
+import re
+import sys
+import time
 
 from conv import *
 from htmls import *
 from md import *
+from profiling import Profile
+from rewrite import LazyPattern
 from seg import *
 from tags import *
 from tex import *
+from walk import walk
 
 
 def reopen(file):
-    import sys
     if sys.platform == 'darwin':
         os.system(f"/usr/bin/open '{file}'")
     else:
@@ -26,7 +32,8 @@ def seek_tags(lines):
     for line in lines:
         if line.text_type == LineType.Tag:
             tags = getattr(line, 'tags', [])
-            return list(set(regularize_tag(tag) for tag in tags))
+            # 去重时保持标签出现的顺序，第一个标签决定笔记放在哪个目录，不能每次运行都不一样
+            return list(dict.fromkeys(regularize_tag(tag) for tag in tags))
 
     return []
 
@@ -39,43 +46,329 @@ def contain_hans(str):
     return any('\u4e00' <= c <= '\u9fa5' for c in str)
 
 
-def format_content(lines, relabel=True):
-    for line in lines:
-        segs = []
-        for s in line.to_segments():
-            if isinstance(s, ImgSeg):
-                segs.append(s.to_html_tag_seg())
+def _debug_log():
+    # 没有导入过 logging 就不可能打开了 debug 级别，不为这个检查去导入 logging
+    logging = sys.modules.get('logging')
+    if logging is None:
+        return None
+    log = logging.getLogger('fmt')
+    return log if log.isEnabledFor(logging.DEBUG) else None
+
+
+def _call(fn, *args, stage=None):
+    return fn(*args)
+
+
+def rule_names():
+    return [rule[0] for rules in (space_rules, quote_rules, code_rules) for rule in rules.rules]
+
+
+class FormatPasses:
+    # format_line 对每个片段依次执行的格式化步骤。每个步骤声明适用的片段类型和触发条件：
+    # 文本里出现 literals 中的某个字面量，或者 chars 字符集中的某个字符，这个步骤才可能改变文本，
+    # 否则直接跳过。触发条件是在执行前对当前文本检查的，前面的步骤改出来的字面量也能触发后面的步骤。
+    # 同一个函数只能注册一次，parse_lines 里执行过的也不能再注册
+    def __init__(self, skip=()):
+        self.skip = tuple(skip)
+        self.passes = []
+        self._plans = {}
+
+    def register(self, name, fn, seg_types=None, literals=(), chars=None):
+        if fn in parse_passes:
+            raise ValueError(f"{name} already runs in parse_lines")
+        if any(n == name or f is fn for n, f, _, _ in self.passes):
+            raise ValueError(f"pass {name} registered twice")
+        alts = [re.escape(lit) for lit in literals] + ([f'[{chars}]'] if chars else [])
+        trigger = LazyPattern('|'.join(alts)) if alts else None
+        self.passes.append((name, fn, tuple(seg_types) if seg_types else None, trigger))
+        self._plans.clear()
+        return self
+
+    def plan(self, seg_type):
+        # 适用于这种片段的 (函数, 触发条件)，按注册顺序
+        plan = self._plans.get(seg_type)
+        if plan is None:
+            if issubclass(seg_type, self.skip):
+                plan = ()
             else:
-                segs.append(s)
-        for seg in segs:
-            print(seg)
-            if isinstance(seg, (CodeSeg, TagSeg, TitleSeg)):
-                continue
-
-            x = seg.text
-            x = convert_to_latex_formula(x, False, False)
-            # x = zoom_img(x)
-            if isinstance(seg, TextSeg):
-                x = remove_space(x)
-            x = replace_tex_command(x)
-            if isinstance(seg, FormulaSeg):
-                # x = remove_space_in_command(x)
-                x = regularize_formula(x)
-            if isinstance(seg, TextSeg):
-                x = detect_new_formula(x)
-                x = conv_to_ruby(x)
-            x = regular_quote(x)
-            x = remove_zhihu_redirect_url(x)
-            x = remove_useless_links(x)
-            seg.text = x
-        line.remain = join_segs(*segs)
+                plan = tuple((fn, trigger) for _, fn, types, trigger in self.passes
+                             if types is None or issubclass(seg_type, types))
+            self._plans[seg_type] = plan
+        return plan
+
+    def apply(self, seg, run=_call):
+        x = seg.text
+        for fn, trigger in self.plan(type(seg)):
+            if trigger is None or trigger.search(x):
+                x = run(fn, x)
+        return x
+
+    def __repr__(self):
+        return f"FormatPasses({','.join(name for name, _, _, _ in self.passes)})"
+
+
+# convert_to_latex_formula 已经在 parse_lines 里对每一行执行过了
+format_passes = FormatPasses(skip=(CodeSeg, TagSeg, TitleSeg)) \
+    .register('remove_space', remove_space, (TextSeg,), chars=r'\s') \
+    .register('replace_tex_command', replace_tex_command, literals=('\\',)) \
+    .register('regularize_formula', regularize_formula, (FormulaSeg,), chars=r'\\\s∇∈≠≃=<>^') \
+    .register('detect_new_formula', detect_new_formula, (TextSeg,), chars='\u4E00-\u9FFF，。') \
+    .register('conv_to_ruby', conv_to_ruby, (TextSeg,), literals=('\\ruby', '☃')) \
+    .register('regular_quote', regular_quote, literals=(',', '，', ' ', ';', '$', '- - ', '\\')) \
+    .register('remove_zhihu_redirect_url', remove_zhihu_redirect_url, literals=('https://link.zhihu.com/?target=',)) \
+    .register('remove_useless_links', remove_useless_links, literals=('https://www.zhihu.com/search?q=',))
+
+
+def format_line(line, profile=None):
+    # profile 不为 None 时每个步骤经过 profile.run 执行，记录耗时和规则命中次数
+    run = _call if profile is None else profile.run
+    log = _debug_log()
+    segs = []
+    for s in run(line.to_segments):
+        if isinstance(s, ImgSeg):
+            segs.append(s.to_html_tag_seg())
+        else:
+            segs.append(s)
+    for seg in segs:
+        if log:
+            log.debug('%s', seg)
+        seg.text = format_passes.apply(seg, run)
+    line.remain = join_segs(*segs)
+    return line
+
+
+class LineMemo(ParseMemo):
+    # 在 ParseMemo 之外再记住 (行类型, 文本) -> 格式化结果。除了标题编号，一行的格式化结果只取决于
+    # 它的类型和文本，没改的行直接取缓存；标题编号在 format_content 最后单独重算
+    def __init__(self, maxsize=1 << 16):
+        super().__init__(maxsize)
+        self.remains = LRU(maxsize)
+
+    def format_line(self, line, profile=None):
+        key = (line.text_type, line.text)
+        remain = self.remains.get(key)
+        if remain is None:
+            format_line(line, profile)
+            self.remains.put(key, line.remain)
+        else:
+            line.remain = remain
+        return line
+
+    def clear(self):
+        super().clear()
+        self.remains.clear()
+
+    def __repr__(self):
+        return f"LineMemo(lines={len(self.remains)}, hits={self.remains.hits}, misses={self.remains.misses})"
+
+
+def format_content(lines, relabel=True, profile=None, memo=None):
+    fmt_line = format_line if memo is None else memo.format_line
+    for line in lines:
+        fmt_line(line, profile)
 
     if relabel:
-        remark_title_seq_no(lines)
+        (_call if profile is None else profile.run)(remark_title_seq_no, lines)
 
     return lines
 
 
+def format_stream(lines, relabel=True, profile=None):
+    # format_content 的流式版本：每格式化一行就产出一行，标题编号用计数器边走边算
+    run = _call if profile is None else profile.run
+    numberer = TitleNumberer()
+    lines = iter(lines)
+    # lines 通常是 parse_lines 的生成器，每取一行都要算到 parse_to_lines 头上
+    while True:
+        line = run(next, lines, None, stage='parse_to_lines')
+        if line is None:
+            break
+        format_line(line, profile)
+        if relabel:
+            run(numberer.mark, line, stage='remark_title_seq_no')
+        yield line
+
+
+def write_lines(lines, out):
+    # 把格式化后的行写到 out，返回第一个标签行里的标签
+    tags = None
+    for i, line in enumerate(lines):
+        if tags is None and line.text_type == LineType.Tag:
+            tags = seek_tags([line])
+        if i:
+            out.write('\n')
+        out.write(line.remain)
+    return tags or []
+
+
+# 一篇文档至少这么多字符时，才值得切块放到多个进程里格式化
+min_chunk_chars = 1 << 16
+
+
+def format_chunk(text, profile=False):
+    # 在子进程里解析并格式化文档的一块。标题编号要看前面所有的标题，留给合并之后统一重算，
+    # 所以只传回每行的结果、重算编号和找标签要用的标题行和标签行 (块内行号, Line)，以及结尾是否还在块里
+    prof = Profile('chunk') if profile else None
+    run = _call if prof is None else prof.run
+    lines = format_content(run(list, parse_to_lines(text), stage='parse_to_lines'), relabel=False, profile=prof)
+    marked = [(i, line) for i, line in enumerate(lines) if line.text_type in (LineType.Title, LineType.Tag)]
+    return [line.remain for line in lines], marked, ends_in_block(lines), prof
+
+
+def format_chunks(chunks, jobs, relabel=False, profile=None):
+    # 各块的结果按顺序拼起来，再对所有标题行统一重算编号，返回 (每行的结果, 标题行和标签行)。
+    # 某块结尾还在块里（公式链接转换出了公式块）时后面的块解析错了，从这一块开始在当前进程里重新格式化
+    from concurrent.futures import ProcessPoolExecutor
+    remains = []
+    marked = []
+    with ProcessPoolExecutor(max_workers=min(jobs, len(chunks))) as pool:
+        results = pool.map(format_chunk, chunks, [profile is not None] * len(chunks))
+        for k, (chunk_remains, chunk_marked, in_block, prof) in enumerate(results):
+            # 重新格式化时丢掉的块不合并它们的 profile，免得同一段文字的耗时算两遍
+            if in_block and k + 1 < len(chunks):
+                chunk_remains, chunk_marked, _, prof = format_chunk('\n'.join(chunks[k:]), profile is not None)
+            if prof:
+                profile.merge(prof)
+            marked.extend((len(remains) + i, line) for i, line in chunk_marked)
+            remains.extend(chunk_remains)
+            if in_block:
+                break
+    if relabel:
+        (_call if profile is None else profile.run)(remark_title_seq_no, [line for _, line in marked])
+        for i, line in marked:
+            remains[i] = line.remain
+    return remains, [line for _, line in marked]
+
+
+def format_text(text, relabel=False, profile=None, memo=None, jobs=1):
+    # jobs > 1 并且文档足够大时，在代码块、公式块之外切块，各块在进程池里格式化，结果和顺序执行一样
+    chunks = split_blocks(text, min(jobs, len(text) // min_chunk_chars)) if jobs > 1 else [text]
+    if len(chunks) > 1:
+        remains, marked = format_chunks(chunks, jobs, relabel, profile)
+        return '\n'.join(remains), seek_tags(marked)
+
+    run = _call if profile is None else profile.run
+    lines = run(list, parse_to_lines(text, memo), stage='parse_to_lines')
+    # for l in lines:
+    #     print(l)
+    lines = format_content(lines, relabel=relabel, profile=profile, memo=memo)
+    tags = seek_tags(lines)
+    content = '\n'.join([x.remain for x in lines])
+    return content, tags
+
+
+def format_file(file, relabel=False, profile=False, memo=None, jobs=1):
+    # 只做解析和格式化，不碰文件系统，可以放到子进程里执行；profile 为真时最后一项是这个文件的 Profile
+    start = time.perf_counter()
+    prof = Profile(file) if profile else None
+    text = read_file(file)
+    content, tags = format_text(text, relabel=relabel, profile=prof, memo=memo, jobs=jobs)
+    return file, content, tags, len(text), time.perf_counter() - start, prof
+
+
+def stream_file(file, relabel=False, profile=False):
+    # 边读边写到临时文件，内存占用只和最长的行有关，适合很大的导出文件
+    start = time.perf_counter()
+    prof = Profile(file) if profile else None
+    tmp = temp_path(file, '.fmt.tmp')
+    try:
+        with open(file, 'r') as src, open(tmp, 'w') as out:
+            tags = write_lines(format_stream(parse_lines(read_lines(src)), relabel, prof), out)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return file, tmp, tags, os.path.getsize(file), time.perf_counter() - start, prof
+
+
+def save_formatted(file, content, tags, syncer=None):
+    if not tags:
+        return dump(file, content, syncer)
+
+    # 这个文件接下来的查询都用这一次刷新的索引
+    refresh_note_index()
+
+    conflict_file = seek_same_name_file(file)
+    if conflict_file:
+        print(f"名字冲突:\n\t当前文件>> {file}\n\t冲突文件>> {conflict_file}")
+        return None
+    return release_to_tag_dirs(file, content, tags, syncer)
+
+
+def record_formatted(cache, file, content, tags, digest, syncer=None):
+    # 写出格式化结果，并在缓存里记下写出内容的 hash；文件被移到标签目录时换成新路径
+    new_path = save_formatted(file, content, tags, syncer)
+    if new_path:
+        if abspath(new_path) != abspath(file):
+            cache.forget(file)
+        cache.record(new_path, digest)
+    return new_path
+
+
+def watch_notes(roots, relabel=False, delay=0.05, use_cache=True, profile=False):
+    # 常驻进程：编译好的规则、笔记索引、每个文件上次写出的结果和格式化过的行都留在内存里，
+    # 文件保存后只重新格式化这一个文件里改过的行。自己写出的文件内容和缓存一致，收到事件也会跳过
+    from cache import FormatCache, content_hash, rules_version
+    from watch import Debouncer, watcher
+
+    cache = FormatCache(os.path.join(note_dir, '.fmt-cache.json'), rules_version(relabel))
+    if use_cache:
+        cache.load()
+    note_index()
+    w = watcher(roots)
+    debouncer = Debouncer(delay)
+    memo = LineMemo()
+    print(f"watching {', '.join(w.roots)} ({type(w).__name__})")
+    try:
+        while True:
+            debouncer.add(w.changes(debouncer.timeout()))
+            for file in debouncer.ready():
+                if not os.path.isfile(file) or cache.is_fresh(file):
+                    continue
+                try:
+                    file, content, tags, _, elapsed, prof = format_file(file, relabel, profile, memo)
+                    record_formatted(cache, file, content, tags, content_hash(content))
+                except Exception as e:
+                    print(f"failed to format {file}: {e!r}")
+                    continue
+                if prof:
+                    print(prof.report(rule_names()))
+                print(f"{elapsed * 1000:8.1f}ms {file}")
+            if use_cache and not len(debouncer):
+                cache.save()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        w.close()
+        if use_cache:
+            cache.save()
+
+
+def expand_files(paths):
+    # 参数可以是文件、目录（递归找 .md 文件）或者通配符
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(e.path for e in walk(path) if not e.is_dir and not e.is_link and e.name.endswith('.md')))
+        elif glob.has_magic(path):
+            files.extend(sorted(f for f in glob.glob(path, recursive=True) if os.path.isfile(f)))
+        else:
+            files.append(path)
+    return list(dict.fromkeys(files))
+
+
+def format_files(files, relabel=False, jobs=1, profile=False):
+    # 解析和格式化在进程池里并行，写文件、移动和链接仍然在当前进程里按顺序执行。
+    # 只有一个文件时改为把这个文件切块并行
+    if jobs <= 1 or len(files) == 1:
+        for f in files:
+            yield format_file(f, relabel, profile, jobs=jobs)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        yield from pool.map(format_file, files, [relabel] * len(files), [profile] * len(files))
+
+
 def main():
     parser = optparse.OptionParser()
     parser.add_option('-f', '--file', dest="file", help="file", default=())
@@ -84,25 +377,100 @@ def main():
     parser.add_option('', '--verbose', dest="verbose", help="verbose", action='store_true', default=False)
     parser.add_option('', '--rmp', dest="rmp", help="remove plus", action='store_true', default=False)
     parser.add_option('', '--keep-graph', dest="keep_graph", help="keep graph", action='store_true', default=False)
+    parser.add_option('-j', '--jobs', dest="jobs", help="format files (or the blocks of a single large file) in N processes", type="int", default=1)
+    parser.add_option('', '--stream', dest="stream", help="format files line by line with bounded memory", action='store_true', default=False)
+    parser.add_option('', '--filter', dest="filter", help="format stdin to stdout", action='store_true', default=False)
+    parser.add_option('', '--no-cache', dest="use_cache", help="reformat unchanged files", action='store_false', default=True)
+    parser.add_option('', '--profile', dest="profile", help="report time per stage and hits per rule", action='store_true', default=False)
+    parser.add_option('', '--watch', dest="watch", help="keep running and reformat notes when they are saved", action='store_true', default=False)
     (options, args) = parser.parse_args()
+    if options.verbose:
+        import logging
+        logging.basicConfig(level=logging.DEBUG, format='%(message)s')
 
-    to_fmts = options.file or args or [find_the_latest_modified_markdown_file(os.getcwd())]
-    for file in to_fmts:
-        lines = list(parse_to_lines(read_file(file)))
-        # for l in lines:
-        #     print(l)
-        lines = format_content(lines, relabel=options.relabel)
-        tags = seek_tags(lines)
-        content = '\n'.join([x.remain for x in lines])
-        if not tags:
-            new_path = dump(file, content)
-        else:
-            conflict_file = seek_same_name_file(file)
-            if conflict_file:
-                print(f"名字冲突:\n\t当前文件>> {file}\n\t冲突文件>> {conflict_file}")
-                continue
-            new_path = release_to_tag_dirs(file, content, tags)
-        reopen(new_path)
+    if options.filter:
+        from contextlib import redirect_stdout
+        prof = Profile('<stdin>') if options.profile else None
+        out = sys.stdout
+        # 格式化过程中任何地方的 print 都不能混进输出里
+        with redirect_stdout(sys.stderr):
+            write_lines(format_stream(parse_lines(read_lines(sys.stdin)), options.relabel, prof), out)
+        if prof:
+            print(prof.report(rule_names()), file=sys.stderr)
+        return
+
+    paths = [options.file] if options.file else args
+    if options.watch:
+        import signal
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        roots = [p if os.path.isdir(p) else os.path.dirname(abspath(p)) for p in paths] or [os.getcwd()]
+        watch_notes(list(dict.fromkeys(roots)), options.relabel, use_cache=options.use_cache, profile=options.profile)
+        return
+
+    from cache import FormatCache, content_hash, file_hash, rules_version
+
+    # 没有给路径时才格式化当前目录下最近修改的笔记；给了路径却没有匹配到文件时什么都不写
+    if paths:
+        to_fmts = expand_files(paths)
+    else:
+        latest = find_the_latest_modified_markdown_file(os.getcwd())
+        to_fmts = [latest] if latest else []
+    if not to_fmts:
+        print("no markdown files matched", file=sys.stderr)
+        sys.exit(1)
+    batch = options.jobs > 1 or len(to_fmts) > 1
+
+    start = time.perf_counter()
+    cache = FormatCache(os.path.join(note_dir, '.fmt-cache.json'), rules_version(options.relabel))
+    if options.use_cache:
+        cache.load()
+        fresh = set(f for f in to_fmts if cache.is_fresh(f))
+        if batch and fresh:
+            print(f"skip {len(fresh)} unchanged files")
+        elif fresh:
+            print(f"{to_fmts[0]} is unchanged since it was last formatted, use --no-cache to reformat it")
+        to_fmts = [f for f in to_fmts if f not in fresh]
+
+    n_bytes = 0
+    total_prof = Profile('total')
+    # 批量格式化时每个目录最后只 fsync 一次
+    syncer = DirSync() if batch else None
+    if options.stream:
+        results = (stream_file(f, options.relabel, options.profile) for f in to_fmts)
+    else:
+        results = format_files(to_fmts, options.relabel, options.jobs, options.profile)
+    try:
+        for file, content, tags, size, elapsed, prof in results:
+            n_bytes += size
+            if prof:
+                print(prof.report(rule_names()))
+                total_prof.merge(prof)
+            if options.stream:
+                tmp = content
+                try:
+                    digest = file_hash(tmp)
+                    with open(tmp, 'r') as content:
+                        new_path = record_formatted(cache, file, content, tags, digest, syncer)
+                finally:
+                    os.remove(tmp)
+            else:
+                new_path = record_formatted(cache, file, content, tags, content_hash(content), syncer)
+            if batch:
+                print(f"{elapsed * 1000:8.1f}ms {file}")
+            elif new_path:
+                reopen(new_path)
+    finally:
+        if syncer is not None:
+            syncer.flush()
+        if options.use_cache:
+            cache.save()
+
+    if options.profile and len(to_fmts) > 1:
+        print(total_prof.report(rule_names()))
+    if batch:
+        total = time.perf_counter() - start
+        print(f"{len(to_fmts)} files, {n_bytes / 1e6:.2f}MB in {total:.2f}s: "
+              f"{len(to_fmts) / total:.1f} files/s, {n_bytes / 1e6 / total:.2f}MB/s")
 
 
 def test():
@@ -1,52 +1,73 @@
+import re
+import string
 from abc import ABC
+from collections import Counter
 from io import StringIO
-from html.parser import HTMLParser
 
+from rewrite import LazyPattern
 
-class MLStripper(HTMLParser, ABC):
-    def __init__(self):
-        super().__init__()
-        self.reset()
-        self.strict = False
-        self.convert_charrefs = True
-        self.text = StringIO()
+_parsers = None
 
-    def handle_data(self, d):
-        self.text.write(d)
 
-    def get_data(self):
-        return self.text.getvalue()
+def _html_parsers():
+    # html.parser 只有回退路径用得到，第一次用的时候再导入并定义两个解析器
+    global _parsers
+    if _parsers is not None:
+        return _parsers
+    from html.parser import HTMLParser
 
+    class MLStripper(HTMLParser, ABC):
+        def __init__(self):
+            super().__init__()
+            self.reset()
+            self.strict = False
+            self.convert_charrefs = True
+            self.text = StringIO()
 
-def strip_html_tags(html):
-    s = MLStripper()
-    s.feed(html)
-    return s.get_data()
+        def handle_data(self, d):
+            self.text.write(d)
 
+        def get_data(self):
+            return self.text.getvalue()
 
-class TagParser(HTMLParser, ABC):
-    def __init__(self):
-        super(TagParser, self).__init__()
-        self.segments = []
+    class TagParser(HTMLParser, ABC):
+        def __init__(self):
+            super(TagParser, self).__init__()
+            self.segments = []
 
-    def handle_starttag(self, tag, attrs):
-        self.segments.append(("tag", tag))
+        def handle_starttag(self, tag, attrs):
+            self.segments.append(("tag", tag))
 
-    def handle_endtag(self, tag):
-        self.segments.append(("tag", tag))
+        def handle_endtag(self, tag):
+            self.segments.append(("tag", tag))
 
-    def handle_data(self, data):
-        self.segments.append(("data", data))
+        def handle_data(self, data):
+            self.segments.append(("data", data))
 
-    def handle_startendtag(self, tag, attrs):
-        self.segments.append(("tag", tag))
+        def handle_startendtag(self, tag, attrs):
+            self.segments.append(("tag", tag))
 
-    def handle_comment(self, data):
-        self.segments.append(("comment", data))
+        def handle_comment(self, data):
+            self.segments.append(("comment", data))
 
+    _parsers = MLStripper, TagParser
+    return _parsers
 
-def seek_html_tag(text: str):
-    parser = TagParser()
+
+def __getattr__(name):
+    if name in ('MLStripper', 'TagParser'):
+        return _html_parsers()[name == 'TagParser']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _strip_by_parser(html):
+    s = _html_parsers()[0]()
+    s.feed(html)
+    return s.get_data()
+
+
+def _seek_html_tag_by_parser(text: str):
+    parser = _html_parsers()[1]()
     segments = parser.segments
     for index, c in enumerate(text):
         parser.feed(c)
@@ -57,9 +78,111 @@ def seek_html_tag(text: str):
     return None
 
 
-import re
+_tag_name_start = frozenset(string.ascii_letters)
+_ws = r'[ \t\n\r\f]'
+_start_tag = re.compile(
+    rf"""<[a-zA-Z][-a-zA-Z0-9:_.]*(?:{_ws}+[a-zA-Z_:][-a-zA-Z0-9_:.]*"""
+    rf"""(?:{_ws}*={_ws}*(?:"[^"]*"|'[^']*'|[^\s"'=<>`]+))?)*{_ws}*/?>""")
+_comment_close = re.compile(r'--\s*>')
+
+
+def scan_html_tag(text: str, pos=0, end=None) -> int:
+    # 识别 text[pos:end] 开头的开始、结束、自闭合标签和注释，返回标签的结束位置，不是标签返回 -1。
+    # 结果和把字符逐个喂给 TagParser 一致，少见的写法（<!doctype>、<?pi>、</> 等）仍然交给 TagParser
+    if end is None:
+        end = len(text)
+    if not text.startswith('<', pos, end) or pos + 1 >= end:
+        return -1
+
+    c = text[pos + 1]
+    if c in _tag_name_start:
+        m = _start_tag.match(text, pos, end)
+        if m:
+            return m.end()
+        if text.find('>', pos + 2, end) < 0:
+            return -1
+    elif c == '/':
+        if not text.startswith('</>', pos, end):
+            gt = text.find('>', pos + 2, end)
+            return gt + 1 if gt >= 0 else -1
+    elif c == '!':
+        if text.startswith('<!--', pos, end):
+            m = _comment_close.search(text, pos + 4, end)
+            return m.end() if m else -1
+    elif c != '?' or text.find('>', pos + 2, end) < 0:
+        return -1
+
+    tag = _seek_html_tag_by_parser(text[pos:end])
+    return pos + len(tag) if tag else -1
+
+
+_markup = re.compile(r'[<&]')
+_tag_name = re.compile(r'[a-zA-Z][-a-zA-Z0-9:_.]*')
+_end_tag = re.compile(rf'</[a-zA-Z][-.a-zA-Z0-9:_]*{_ws}*>')
+# script、style 里的内容 HTMLParser 不当作标签解析
+_cdata_tags = frozenset(('script', 'style'))
+
+# plain: 没有标签和字符引用，原样返回；scan: 只有普通标签，直接扫描；parser: 交给 MLStripper
+strip_counters = Counter()
+
+
+def _strip_simple_tags(html):
+    # 只处理普通的开始、结束、自闭合标签、注释和不构成标签的 "<"，遇到别的写法返回 None
+    acc = []
+    pos = 0
+    n = len(html)
+    while True:
+        lt = html.find('<', pos)
+        if lt < 0:
+            acc.append(html[pos:])
+            return ''.join(acc)
+        acc.append(html[pos:lt])
+        if lt + 1 >= n:
+            return None
+
+        c = html[lt + 1]
+        if c in _tag_name_start:
+            m = _start_tag.match(html, lt)
+            if not m or _tag_name.match(html, lt + 1).group().lower() in _cdata_tags:
+                return None
+            pos = m.end()
+        elif c == '/':
+            m = _end_tag.match(html, lt)
+            if not m:
+                return None
+            pos = m.end()
+        elif c == '!':
+            m = _comment_close.search(html, lt + 4) if html.startswith('<!--', lt) else None
+            if not m:
+                return None
+            pos = m.end()
+        elif c == '?':
+            return None
+        else:
+            acc.append('<')
+            pos = lt + 1
+
+
+def strip_html_tags(html):
+    # 和 MLStripper 的结果一样（包括 convert_charrefs 的处理），没有标记的文本直接返回
+    if not _markup.search(html):
+        strip_counters['plain'] += 1
+        return html
+    if '&' not in html:
+        text = _strip_simple_tags(html)
+        if text is not None:
+            strip_counters['scan'] += 1
+            return text
+    strip_counters['parser'] += 1
+    return _strip_by_parser(html)
+
+
+def seek_html_tag(text: str):
+    index = scan_html_tag(text)
+    return text[:index] if index >= 0 else None
+
 
-_ruby_pattern = re.compile(r"(?:\\ruby|☃)([\u4e00-\u9fa5·]+)\(([^)]+)\)")
+_ruby_pattern = LazyPattern(r"(?:\\ruby|☃)([\u4e00-\u9fa5·]+)\(([^)]+)\)")
 
 
 def conv_to_ruby(line):
@@ -1,13 +1,187 @@
-from PIL import Image
+import io
+import mmap
+import re
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
 import requests
+from requests.adapters import HTTPAdapter
+
+# (连接超时, 读超时)
+default_timeout = (3.05, 10)
+default_workers = 16
+# 同一个域名同时进行的请求数，知乎的图片都在几个 zhimg 域名下，太多会被限流
+default_per_host = 4
+
+# 先用 Range 请求图片开头的 _probe_bytes 字节解析尺寸，不够再扩大，最多读 _max_probe_bytes
+_probe_bytes = 1024
+_max_probe_bytes = 1 << 18
+_chunk_size = 1024
+
+_sessions = {}
+_session_lock = threading.Lock()
+
+
+def session(per_host=default_per_host):
+    # 所有请求共用连接池，同一个域名的连接可以复用。每个域名的连接池和同时进行的请求数一样大，
+    # 连接池比并发数小时，多出来的连接用完就被丢掉
+    with _session_lock:
+        s = _sessions.get(per_host)
+        if s is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=default_workers, pool_maxsize=per_host)
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            _sessions[per_host] = s
+    return s
+
+
+def _jpeg_size(data):
+    # 依次跳过各个段，直到遇到 SOF 段，SOF 段里依次是 长度、精度、高、宽
+    pos = 2
+    n = len(data)
+    while pos + 4 <= n:
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            pos += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if pos + 9 > n:
+                return None
+            height, width = struct.unpack('>HH', data[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + struct.unpack('>H', data[pos + 2:pos + 4])[0]
+    return None
+
+
+def _webp_size(data):
+    if len(data) < 30:
+        return None
+    chunk = data[12:16]
+    if chunk == b'VP8 ' and data[23:26] == b'\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and data[20] == 0x2F:
+        bits = struct.unpack('<I', data[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X':
+        width = int.from_bytes(data[24:27], 'little') + 1
+        height = int.from_bytes(data[27:30], 'little') + 1
+        return width, height
+    return None
+
+
+_signatures = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8', b'GIF87a', b'GIF89a', b'RIFF', b'BM')
+
+
+def _probeable(data):
+    # 开头已经不是认识的格式时，就不用再多读了
+    return any(data[:len(sig)] == sig[:len(data)] for sig in _signatures)
+
+
+def image_size(data):
+    # 只根据文件开头的字节解析 PNG、JPEG、GIF、WebP、BMP 的尺寸，数据不够或者格式不认识时返回 None
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        if len(data) >= 24 and data[12:16] == b'IHDR':
+            return struct.unpack('>II', data[16:24])
+        return None
+    if data[:2] == b'\xff\xd8':
+        return _jpeg_size(data)
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        if len(data) >= 10:
+            return struct.unpack('<HH', data[6:10])
+        return None
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return _webp_size(data)
+    if data[:2] == b'BM' and len(data) >= 26:
+        if struct.unpack('<I', data[14:18])[0] == 12:
+            return struct.unpack('<HH', data[18:22])
+        width, height = struct.unpack('<ii', data[18:26])
+        return width, abs(height)
+    return None
+
+
+def _pil_size(fp):
+    # 解析不了的格式才交给 PIL，用到的时候再导入
+    from PIL import Image
+    try:
+        return Image.open(fp).size
+    except OSError:
+        return None
 
 
-def get_size_of_img(url):
-    r = requests.get(url, stream=True)
-    if not r.ok:
+def _local_size(path):
+    try:
+        with open(path, 'rb') as f:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    size = image_size(m)
+            except ValueError:
+                return None
+            if size:
+                return tuple(size)
+            f.seek(0)
+            return _pil_size(f)
+    except OSError:
+        return None
+
+
+def _probe(head, chunks, want):
+    # 从 chunks 往 head 里读，直到解析出尺寸、读够 want 字节或者开头已经不是认识的格式
+    for chunk in chunks:
+        head += chunk
+        size = image_size(head)
+        if size:
+            return tuple(size)
+        if len(head) >= want or not _probeable(head):
+            break
+    return None
+
+
+def _remote_size(url, timeout, per_host):
+    # 解析不了尺寸时，把已经读到的字节接上同一个响应剩下的部分交给 PIL，一张图最多下载一遍
+    head = bytearray()
+    want = _probe_bytes
+    rest = False
+    while True:
+        headers = {'Range': f'bytes={len(head)}-' if rest else f'bytes={len(head)}-{want - 1}'}
+        with session(per_host).get(url, stream=True, timeout=timeout, headers=headers) as r:
+            if r.status_code == 416 and head:
+                # 文件的长度正好停在上一次读到的位置
+                return _pil_size(io.BytesIO(head))
+            if not r.ok:
+                return None
+            chunks = r.iter_content(_chunk_size)
+            if r.status_code != 206:
+                # 服务端不支持 Range，返回的是整个文件，在这个响应里读到够用为止
+                head, want, rest = bytearray(), _max_probe_bytes, False
+            size = None if rest else _probe(head, chunks, want)
+            if size:
+                return size
+            head += b''.join(chunks)
+            if rest or r.status_code != 206 or len(head) < want:
+                # 已经读到文件末尾
+                return _pil_size(io.BytesIO(head))
+        # 读够了 _max_probe_bytes 或者不是认识的格式，下一次把剩下的部分一起读完
+        rest = want >= _max_probe_bytes or not _probeable(head)
+        want = min(want * 4, _max_probe_bytes)
+
+
+def get_size_of_img(url, timeout=default_timeout, per_host=default_per_host):
+    if not url.startswith(('http://', 'https://')):
+        return _local_size(url[len('file://'):] if url.startswith('file://') else url)
+
+    try:
+        return _remote_size(url, timeout, per_host)
+    except requests.RequestException:
         return None
-    image = Image.open(r.raw)
-    return image.size
 
 
 def zoom_ratio(width, height, max_width=None, max_height=None):
@@ -28,3 +202,48 @@ def calc_zoom_ratio(url, max_width=None, max_height=None):
 
     width, height = size
     return zoom_ratio(width, height, max_width, max_height)
+
+
+class HostLimiter:
+    # 每个域名一个信号量，限制同一个域名同时进行的请求数
+    def __init__(self, limit=default_per_host):
+        self.limit = limit
+        self._sems = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            sem = self._sems.get(host)
+            if sem is None:
+                sem = self._sems[host] = threading.BoundedSemaphore(self.limit)
+        return sem
+
+
+def calc_zoom_ratios(urls, max_width=None, max_height=None,
+                     workers=default_workers, per_host=default_per_host, timeout=default_timeout):
+    # 批量计算图片的缩放比例：去重后并发请求，返回 {url: ratio}，取不到尺寸的图片为 100
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        return {}
+
+    limiter = HostLimiter(per_host)
+
+    def ratio(url):
+        with limiter(url):
+            size = get_size_of_img(url, timeout, per_host)
+        if size is None:
+            return url, 100
+        width, height = size
+        return url, zoom_ratio(width, height, max_width, max_height)
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(urls))) as pool:
+        return dict(pool.map(ratio, urls))
+
+
+_img_url = re.compile(r'!\[[^\]]*]\((https?://[^)\s]+)|<img\b[^>]*?\bsrc\s*=\s*["\'](https?://[^"\']+)')
+
+
+def seek_img_urls(text):
+    # 文档里 markdown 图片和 <img> 标签的链接，按出现顺序去重
+    return list(dict.fromkeys(m.group(1) or m.group(2) for m in _img_url.finditer(text)))
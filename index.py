@@ -0,0 +1,146 @@
+import json
+import os
+import time
+
+from walk import default_workers, scan_dir, walk_dirs
+
+_version = 1
+# mtime 离扫描时间太近的目录可能在同一个时间粒度内又被修改，下次刷新时重新扫描
+_racy_seconds = 2
+
+
+class NoteIndex:
+    # 笔记目录树的持久化索引，记录每个目录的 mtime 和它的直接子目录、文件、符号链接。
+    # 刷新时只重新列出 mtime 变化了的目录，查询不再需要遍历整棵目录树。
+    def __init__(self, root, path=None):
+        self.root = os.path.expanduser(root)
+        self.path = path or os.path.join(self.root, '.note-index.json')
+        self.dirs = {}
+        self._changed = False
+        self._lookup = None
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return self
+        if isinstance(data, dict) and data.get('version') == _version:
+            self.dirs = data.get('dirs', {})
+            self._lookup = None
+        return self
+
+    def save(self):
+        if not self._changed:
+            return self
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'version': _version, 'dirs': self.dirs}, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+            self._changed = False
+        except OSError:
+            pass
+        return self
+
+    def refresh(self, workers=default_workers):
+        now = time.time()
+        seen = set()
+        for rel, node in walk_dirs('', lambda rel: self._visit(rel, now), workers):
+            if node is None:
+                continue
+            seen.add(rel)
+            old = self.dirs.get(rel)
+            if old is node:
+                continue
+            if old is None or any(old[k] != node[k] for k in ('dirs', 'files', 'links')):
+                self._lookup = None
+            self.dirs[rel] = node
+            self._changed = True
+
+        for rel in set(self.dirs) - seen:
+            del self.dirs[rel]
+            self._changed = True
+            self._lookup = None
+        return self
+
+    def _path_of(self, rel):
+        return os.path.join(self.root, rel) if rel else self.root
+
+    def _visit(self, rel, now):
+        # 在遍历线程里执行：mtime 没变的目录直接沿用索引里的子项
+        path = self._path_of(rel)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None, ()
+        node = self.dirs.get(rel)
+        if node is None or node['mtime'] != mtime:
+            node = self._scan(path, mtime, now)
+        return node, [os.path.join(rel, d) for d in node['dirs']]
+
+    @staticmethod
+    def _scan(path, mtime, now):
+        dirs, files, links = [], [], {}
+        for e in scan_dir(path)[0]:
+            if e.is_link:
+                try:
+                    links[e.name] = os.readlink(e.path)
+                except OSError:
+                    continue
+            elif e.is_dir:
+                dirs.append(e.name)
+            else:
+                files.append(e.name)
+        return {
+            'mtime': mtime if now - mtime >= _racy_seconds else None,
+            'dirs': sorted(dirs),
+            'files': sorted(files),
+            'links': links,
+        }
+
+    def walk(self):
+        # 和 os.walk 一样先序遍历，同一目录下的子目录按名字排序
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            node = self.dirs.get(rel)
+            if node is None:
+                continue
+            yield rel, node
+            stack.extend(reversed([os.path.join(rel, d) for d in node['dirs']]))
+
+    def _lookups(self):
+        if self._lookup is not None:
+            return self._lookup
+
+        dirs, files, links = {}, {}, []
+        for rel, node in self.walk():
+            base = os.path.abspath(self._path_of(rel))
+            children = sorted([(d, False) for d in node['dirs']] + [(l, True) for l in node['links']])
+            for name, is_link in children:
+                dirs.setdefault(name.lower(), []).append((os.path.join(base, name), is_link))
+            for name in node['files']:
+                files.setdefault(name, []).append(os.path.join(base, name))
+            for name, target in sorted(node['links'].items()):
+                links.append((os.path.join(base, name), target))
+        self._lookup = dirs, files, links
+        return self._lookup
+
+    def seek_dir(self, name):
+        # 不区分大小写地找名字为 name 的目录，指向目录的符号链接也算
+        for path, is_link in self._lookups()[0].get(name.lower(), ()):
+            if not is_link or os.path.isdir(path):
+                return path
+        return None
+
+    def seek_files(self, basename):
+        # 名字为 basename 的普通文件，不包括符号链接
+        return list(self._lookups()[1].get(basename, ()))
+
+    def symlinks(self):
+        # 所有符号链接和它们 readlink 得到的目标
+        return list(self._lookups()[2])
+
+    def __repr__(self):
+        return f"NoteIndex(root={self.root}, dirs={len(self.dirs)})"
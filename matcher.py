@@ -2,26 +2,96 @@ import re
 from typing import Optional, Tuple
 
 
+_reg_cache = {}
+
+
 class Reg:
     def __init__(self, pattern):
         self.pattern = pattern
 
+    def compile(self):
+        # 没有锚定的模式默认从当前位置开始匹配，编译结果按模式缓存
+        r = self.pattern
+        if not isinstance(r, str):
+            return r
+        compiled = _reg_cache.get(r)
+        if compiled is None:
+            compiled = re.compile('^' + r if not r.startswith('^') and not r.endswith('$') else r)
+            _reg_cache[r] = compiled
+        return compiled
+
     def __repr__(self):
         return f"Reg({self.pattern})"
 
 
+_util_cache = {}
+
+
+def _util_pattern(delim):
+    # match_util 一次跳到下一个可能的位置：分隔符、转义的反斜杠或者换行
+    p = _util_cache.get(delim)
+    if p is None:
+        p = re.compile(re.escape(delim) + r'|[\\\n]')
+        _util_cache[delim] = p
+    return p
+
+
+_at_cache = {}
+
+
+def _at_pattern(r):
+    # 没有锚定的字符串模式原样编译，用 match(text, pos) 从当前位置匹配，不用复制剩余的文本。
+    # 以 ^ 开头或者 $ 结尾的模式和编译好的正则返回 None，仍然在剩余文本上匹配
+    if not isinstance(r, str) or r.startswith('^') or r.endswith('$'):
+        return None
+    compiled = _at_cache.get(r)
+    if compiled is None:
+        compiled = _at_cache[r] = re.compile(r)
+    return compiled
+
+
 class Matcher:
-    def __init__(self, text):
-        self.remain = text
+    # 只保存原始文本和当前位置，匹配时不再复制剩余的文本
+    def __init__(self, text, pos=0):
+        self.text = text
+        self.pos = pos
         self.captured = None
 
+    @property
+    def remain(self):
+        return self.text[self.pos:]
+
+    @remain.setter
+    def remain(self, text):
+        self.text = text
+        self.pos = 0
+
     def match(self, *patterns) -> Optional[Tuple[str, str]]:
-        res = self.peek(*patterns)
+        res = self._peek(*patterns)
         if res is None:
             return None
-        cap, self.remain = res
+        cap, self.pos = res
+        self.acc_captured(cap)
+        return cap, self.remain
+
+    # advance* 和对应的 match* 一样移动位置、累积 captured，但只返回结束的位置，没匹配上返回 -1，
+    # 不构造剩余的文本。逐段解析一行时用这些，remain 只留给需要它的调用方
+
+    def advance(self, *patterns) -> int:
+        res = self._peek(*patterns)
+        if res is None:
+            return -1
+        cap, self.pos = res
         self.acc_captured(cap)
-        return res
+        return self.pos
+
+    def advance_util(self, delim) -> int:
+        return self._advance_util(delim, self.pos)
+
+    def advance_pair(self, delim) -> int:
+        if not isinstance(delim, str) or not self.text.startswith(delim, self.pos):
+            return -1
+        return self._advance_util(delim, self.pos + len(delim))
 
     def acc_captured(self, cap):
         if cap is None:
@@ -32,27 +102,45 @@ class Matcher:
         else:
             self.captured += cap
 
-    def match_util(self, delim) -> Optional[Tuple[str, str]]:
-        try:
-            matcher = Matcher(self.remain)
-            while True:
-                c, text = matcher.match(delim, Reg(r'\\?.'))
-                if c == delim:
-                    self.remain = matcher.remain
-                    self.acc_captured(matcher.captured)
-                    return matcher.captured, matcher.remain
-        except:
+    def _seek_util(self, delim, pos):
+        # 返回 delim 结束的位置，遇到换行或者到了文本末尾返回 -1；反斜杠会转义它后面的字符
+        text = self.text
+        pattern = _util_pattern(delim)
+        while True:
+            m = pattern.search(text, pos)
+            if not m:
+                return -1
+            c = m.group()
+            if c == delim:
+                return m.end()
+            if c == '\n':
+                return -1
+            pos = m.start()
+            pos += 2 if text[pos + 1:pos + 2] not in ('', '\n') else 1
+
+    def _advance_util(self, delim, pos):
+        if not isinstance(delim, str):
+            return -1
+        end = self._seek_util(delim, pos)
+        if end < 0:
+            return -1
+        self.acc_captured(self.text[self.pos:end])
+        self.pos = end
+        return end
+
+    def _match_util(self, delim, pos):
+        start = self.pos
+        if self._advance_util(delim, pos) < 0:
             return None
+        return self.text[start:self.pos], self.remain
+
+    def match_util(self, delim) -> Optional[Tuple[str, str]]:
+        return self._match_util(delim, self.pos)
 
     def match_pair(self, delim):
-        try:
-            m = Matcher(self.remain)
-            if m.match(delim) and m.match_util(delim):
-                self.remain = m.remain
-                self.acc_captured(m.captured)
-                return m.captured, m.remain
-        except:
+        if not isinstance(delim, str) or not self.text.startswith(delim, self.pos):
             return None
+        return self._match_util(delim, self.pos + len(delim))
 
     def __bool__(self):
         return self.captured is not None
@@ -64,26 +152,28 @@ class Matcher:
         if not regexps:
             raise ValueError("nil regexps")
         for r in regexps:
-            if isinstance(r, str):
-                if not r.startswith('^') and not r.endswith('$'):
-                    r = '^' + r
-                r = re.compile(r)
-            assert isinstance(r, re.Pattern)
-            m = r.search(self.remain)
+            at = _at_pattern(r)
+            if at is not None:
+                m = at.match(self.text, self.pos)
+            else:
+                r = Reg(r).compile()
+                assert isinstance(r, re.Pattern)
+                # 正则的 ^ 要以剩余文本为准，这里仍然在剩余文本上匹配
+                m = r.search(self.remain)
             if not m:
                 return None
-            return m.group(0), self.remain[len(m.group(0)):]
+            return m.group(0), self.pos + len(m.group(0))
         return None
 
     def _try_match_str(self, *starts):
         if not starts:
             raise ValueError("nil starts")
         for s in starts:
-            if self.remain.startswith(s):
-                return s, self.remain[len(s):]
+            if self.text.startswith(s, self.pos):
+                return s, self.pos + len(s)
         return None
 
-    def try_match(self, *patterns):
+    def _peek(self, *patterns):
         if not patterns:
             raise ValueError("nil patterns")
 
@@ -101,6 +191,13 @@ class Matcher:
                 return m
         return None
 
+    def try_match(self, *patterns):
+        res = self._peek(*patterns)
+        if res is None:
+            return None
+        cap, pos = res
+        return cap, self.text[pos:]
+
     def __repr__(self):
         return f"Matcher(captured={self.captured}, remain={self.remain})"
 
@@ -1,8 +1,10 @@
-from collections import defaultdict
+from bisect import bisect_right
+from collections import OrderedDict, defaultdict
 from enum import Enum
 
 from conv import *
 from htmls import strip_html_tags
+from rewrite import LazyPattern, Rewriter
 from seg import *
 
 
@@ -66,28 +68,194 @@ def extract_tags(line):
     return [t.strip().lower() for t in _tags_delim.split(tags)]
 
 
-def parse_to_lines(text: str) -> Iterable[Line]:
+_newline = re.compile(r'[\r\n]')
+_chunk_size = 1 << 16
+
+
+def split_lines(chunks: Iterable[str]) -> Iterable[str]:
+    # 和 re.split(r'[\r\n]', text) 的结果一样，但是按块读入，内存里只保留最后一个不完整的行。
+    # 不完整的行先按块存在列表里，遇到换行时才拼起来，很长的行也不会反复拷贝
+    rest = []
+    for chunk in chunks:
+        parts = _newline.split(chunk)
+        rest.append(parts[0])
+        if len(parts) == 1:
+            continue
+        yield ''.join(rest)
+        yield from parts[1:-1]
+        rest = [parts[-1]]
+    yield ''.join(rest)
+
+
+def read_lines(f, chunk_size=_chunk_size) -> Iterable[str]:
+    return split_lines(iter(lambda: f.read(chunk_size), ''))
+
+
+def parse_to_lines(text: str, memo=None) -> Iterable[Line]:
+    return parse_lines(_newline.split(text), memo)
+
+
+def _convert_raw(raw):
+    return _newline.split(convert_to_latex_formula(regular_char(raw), False, False))
+
+
+def _classify(state, line):
+    if state == LineType.Code:
+        return expect_code_end(line) or Line(line, LineType.Code)
+    if state == LineType.Formulation:
+        return expect_formula_end(line) or Line(line, LineType.Formulation)
+    return expect_code(line) or \
+        expect_formula(line) or \
+        expect_title(line) or \
+        expect_blockquote(line) or \
+        expect_tag(line) or \
+        expect_html(line) or \
+        Line(text=line, text_type=LineType.Text)
+
+
+def parse_lines(raw_lines: Iterable[str], memo=None) -> Iterable[Line]:
+    # 逐行转换字符和公式链接，再用代码块、公式块的状态机分类，可以处理流式的输入
+    convert = _convert_raw if memo is None else memo.convert
+    classify = _classify if memo is None else memo.classify
     prev_type = LineType.Text
 
-    lines = re.split(r'[\r\n]', regular_char(text))
-    lines = '\n'.join([convert_to_latex_formula(x, False, False)
-                      for x in lines])
-    lines = re.split(r'[\r\n]', lines)
-    for line in lines:
-        if prev_type == LineType.Code:
-            seg = expect_code_end(line) or Line(line, LineType.Code)
-        elif prev_type == LineType.Formulation:
-            seg = expect_formula_end(line) or Line(line, LineType.Formulation)
-        else:
-            seg = expect_code(line) or \
-                expect_formula(line) or \
-                expect_title(line) or \
-                expect_blockquote(line) or \
-                expect_tag(line) or \
-                expect_html(line) or \
-                Line(text=line, text_type=LineType.Text)
-        yield seg
-        prev_type = seg.text_type
+    for raw in raw_lines:
+        for line in convert(raw):
+            state = prev_type if prev_type in (LineType.Code, LineType.Formulation) else None
+            seg = classify(state, line)
+            yield seg
+            prev_type = seg.text_type
+
+
+# 原文里进入或者离开代码块、公式块的行一定含有这些字面量。公式链接转换出来的公式块在这里看不到，
+# 按切块格式化时由 ends_in_block 检查每块结尾的状态
+_block_markers = ('```', '$$')
+
+
+def _line_span(text, i):
+    # 位置 i 所在的行的 [起点, 终点)，终点是换行符的位置
+    nl = text.rfind('\n', 0, i)
+    start = max(nl, text.rfind('\r', nl + 1, i)) + 1
+    m = _newline.search(text, i)
+    return start, m.start() if m else len(text)
+
+
+def _block_spans(text):
+    # 用 str.find 找出含有标记的行，只对这些行执行 parse_lines 的状态机，
+    # 返回代码块、公式块占据的 [首行起点, 末行终点) 列表
+    marked = {}
+    for marker in _block_markers:
+        i = text.find(marker)
+        while i >= 0:
+            start, end = _line_span(text, i)
+            marked[start] = end
+            i = text.find(marker, end)
+
+    spans = []
+    state = None
+    open_at = None
+    for start in sorted(marked):
+        end = marked[start]
+        for line in _convert_raw(text[start:end]):
+            text_type = _classify(state, line).text_type
+            state = text_type if text_type in (LineType.Code, LineType.Formulation) else None
+        if state is not None and open_at is None:
+            open_at = start
+        elif state is None and open_at is not None:
+            spans.append((open_at, end))
+            open_at = None
+    if open_at is not None:
+        spans.append((open_at, len(text)))
+    return spans
+
+
+def split_blocks(text, n):
+    # 在代码块、公式块之外的换行处把文档切成至多 n 块，大小尽量平均，每个切点去掉一个换行符。
+    # 只要前面各块的结尾都不在块里（见 ends_in_block），每块单独 parse_to_lines 的结果依次拼起来，
+    # 就和整篇 parse_to_lines 的结果一样
+    if n <= 1:
+        return [text]
+    spans = _block_spans(text)
+    starts = [s for s, _ in spans]
+    chunks = []
+    pos = 0
+    for k in range(1, n):
+        m = _newline.search(text, max(pos, len(text) * k // n))
+        if not m:
+            break
+        cut = m.start()
+        i = bisect_right(starts, cut) - 1
+        if i >= 0 and cut < spans[i][1]:
+            cut = spans[i][1]
+        if cut >= len(text):
+            break
+        chunks.append(text[pos:cut])
+        pos = cut + 1
+    chunks.append(text[pos:])
+    return chunks
+
+
+def ends_in_block(lines):
+    # 解析到最后一行时是否还在代码块、公式块里，也就是 parse_lines 解析下一行时的状态
+    return bool(lines) and lines[-1].text_type in (LineType.Code, LineType.Formulation)
+
+
+class LRU:
+    # 有容量上限的缓存，满了之后淘汰最久没用过的
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._items[key] = value
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class ParseMemo:
+    # 解析的每一步都只取决于这一行的文本（分类还取决于是否在代码块、公式块里），
+    # 记住结果后，改了少数几行的文档再解析时，没改的行直接取缓存
+    def __init__(self, maxsize=1 << 16):
+        self.converted = LRU(maxsize)
+        self.classified = LRU(maxsize)
+
+    def convert(self, raw):
+        lines = self.converted.get(raw)
+        if lines is None:
+            lines = self.converted.put(raw, tuple(_convert_raw(raw)))
+        return lines
+
+    def classify(self, state, line):
+        # 缓存里的 Line 只当模板，每次返回一个副本，格式化时写入的 remain 不会互相影响
+        key = (state, line)
+        template = self.classified.get(key)
+        if template is None:
+            template = self.classified.put(key, _classify(state, line))
+        seg = Line.__new__(Line)
+        seg.__dict__.update(template.__dict__)
+        return seg
+
+    def clear(self):
+        self.converted.clear()
+        self.classified.clear()
 
 
 def expect_formula(line: str) -> Optional[Line]:
@@ -155,22 +323,60 @@ def expect_html(line: str) -> Optional[Line]:
     return None
 
 
-_normalize_char = {
+_custom_char = {
     '\t': ' ', '〈': '⟨', '〉': '⟩',
     '≤': '⩽', '≥': '⩾', "〞": "”", "〝": "“", '（': '(', '）': ')',
-    '量': '量', '⾥': '里', '⾯': '面', '⽤': '用',
+    # U+F97E 是兼容汉字，写成转义，免得编辑器按 NFC 把它换成 U+91CF
+    '\uf97e': '量', '⾥': '里', '⾯': '面', '⽤': '用',
     '⼤': '大', '⽽': '而', '⼀': '一', '⽅': '方',
 }
 
 
+def _radical_chars():
+    # PDF 复制出来的文字里常混有部首字符，康熙部首 (U+2F00-U+2FDF) 和 CJK 部首补充 (U+2E80-U+2EFF)
+    # 里有兼容分解的字符按 NFKC 换成对应的汉字
+    import unicodedata
+    for code in range(0x2E80, 0x2FE0):
+        c = chr(code)
+        n = unicodedata.normalize('NFKC', c)
+        if n != c and len(n) == 1:
+            yield c, n
+
+
+# 部首字符都不是 ASCII，ASCII 文本要替换的字符只在 _custom_char 里
+_ascii_normalize = [(k, v) for k, v in _custom_char.items() if k.isascii()]
+_normalize = None
+
+
+def _normalize_tables():
+    # 替换表和要替换的字符集，第一次遇到非 ASCII 文本时才生成，导入模块时不付这个开销
+    global _normalize
+    if _normalize is None:
+        chars = {**dict(_radical_chars()), **_custom_char}
+        _normalize = str.maketrans(chars), re.compile('[' + ''.join(re.escape(c) for c in chars) + ']')
+    return _normalize
+
+
 def regular_char(text):
-    text = ''.join(_normalize_char.get(c, c) for c in text)
-    return text
+    # 纯 ASCII 的文本只需要替换少数几个字符；其余文本先用字符集搜一遍，没有要替换的字符就原样返回
+    if text.isascii():
+        for k, v in _ascii_normalize:
+            if k in text:
+                text = text.replace(k, v)
+        return text
+    table, pattern = _normalize_tables()
+    if not pattern.search(text):
+        return text
+    return text.translate(table)
+
+
+# parse_lines 对每一行原始文本都已经执行过的步骤，格式化阶段不再重复执行
+parse_passes = (regular_char, convert_to_latex_formula)
 
 
 def remove_zhihu_redirect_url(line):
     from urllib.parse import unquote
-    p = r'(^.*]\()https://link.zhihu.com/\?target=([^)]+)(\).*)$'
+    p = r'(^.*]\()https://link\.zhihu\.com/\?target=([^)]+)(\).*)$'
     while True:
         m = re.search(p, line)
         if not m:
@@ -178,37 +384,43 @@ def remove_zhihu_redirect_url(line):
         line = m.group(1) + unquote(m.group(2)) + m.group(3)
 
 
-def remove_space(text):
-    text = re.sub(
-        r'(?<=[\u3400-\u4DBF\u4E00-\u9FFF]) (?=[a-zA-Z0-9])', '', text)
-    text = re.sub(
-        r'(?<=[a-zA-Z0-9]) (?=[\u3400-\u4DBF\u4E00-\u9FFF])', '', text)
-    text = re.sub(
-        r'(?<=[\u3400-\u4DBF\u4E00-\u9FFF]) (?=[\u3400-\u4DBF\u4E00-\u9FFF])', '', text)
-    text = re.sub(r'(?<=[，。()])\s+', '', text)
-    text = re.sub(r' (?=[，。（）()])', '', text)
-    return text
+_han = '\u3400-\u4DBF\u4E00-\u9FFF'
+_hans = '\u4e00-\u9fa5'
 
+# remove_space 和 regular_quote 的规则表，每个函数对文本只扫描一遍。
+# 新的空格、标点规则直接 add 到对应的表里即可，不需要再加一遍全文扫描。
+space_rules = Rewriter(
+    ('space-after-punct', r'\s', r'(?<=[，。()])\s+', ''),
+    ('space-before-punct', ' ', r' (?=[，。（）()])', ''),
+    ('space-after-han', ' ', rf'(?<=[{_han}]) (?=[{_han}a-zA-Z0-9])', ''),
+    ('space-before-han', ' ', rf'(?<=[a-zA-Z0-9]) (?=[{_han}])', ''),
+)
+
+
+def remove_space(text):
+    return space_rules.sub(text)
 
-def regular_quote(text):
-    text = re.sub(r'(?<=[\u3400-\u4DBF\u4E00-\u9FFF]),', r'，', text)
-    # text = re.sub(rf'(?<=[$])(?=[\u4E00-\u9FFF])', r' ', text)
-    # text = re.sub(rf'(?<=[\u4e00-\u9fff])(?=[$])', r' ', text)
 
+quote_rules = Rewriter(
+    # 汉字后的逗号转为中文逗号，并删除其后的空白
+    ('comma-after-han', ',', rf'(?<=[{_han}]),\s*', '，'),
+    ('space-after-comma', '，', r'，\s+', '，'),
     # 删除汉字之间的空格
-    text = re.sub(rf'(?<=[\u4e00-\u9fa5，。]) (?=[\u4e00-\u9fa5，。])', r'', text)
-    text = re.sub(r',(?=[\u4e00-\u9fa5])', r'，', text)
-    text = re.sub(r'(?<=[\u4e00-\u9fa5]);', r'；', text)
-    text = re.sub(r';(?=[\u4e00-\u9fa5])', r'；', text)
-    text = re.sub(r'，\s+', r'，', text)
-    text = re.sub(r'\$([A-Z])\$', r'\1', text)
-    text = re.sub(r'- - ', r'\t- ', text)
-    text = re.sub(r'^\\(\d)\. ', r'\1. ', text)
+    ('space-between-hans', ' ', rf'(?<=[{_hans}。]) (?=[{_hans}，。])', ''),
+    ('comma-before-hans', ',', rf',(?=[{_hans}])', '，'),
+    ('semicolon-after-hans', ';', rf'(?<=[{_hans}]);', '；'),
+    ('semicolon-before-hans', ';', rf';(?=[{_hans}])', '；'),
+    ('single-upper-formula', r'\$', r'\$([A-Z])\$', r'\1'),
+    ('nested-list', '-', r'- - ', '\t- '),
+    ('escaped-order', r'\\', r'^\\(\d)\. ', r'\1. '),
+)
 
-    return text
 
+def regular_quote(text):
+    return quote_rules.sub(text)
 
-_internal_title_seq_no_pattern = re.compile(
+
+_internal_title_seq_no_pattern = LazyPattern(
     r'^([⓿❶-❿⓫-⓴①-⑳⓵-⓾ⓐ-ⓩ㊀-㊉]|\d(\.\d)+|(\d\.)+|[一二三四五六七八九十\d]+[、])')
 
 
@@ -223,44 +435,54 @@ def trim_internal_title_seq_no(text):
 _max_level = 6
 
 
-def remark_title_seq_no(lines):
-    level2seq = {
-        2: '❶❷❸❹❺❻❼❽❾❿⓫⓬⓭⓮⓯⓰⓱⓲⓳⓴',
-        3: '①②③④⑤⑥⑦⑧⑨⑩⑪⑫⑬⑭⑮⑯⑰⑱⑲⑳',
-        4: '⓵⓶⓷⓸⓹⓺⓻⓼⓽⓾',
-        # 5: 'ⓐⓑⓒⓓⓔⓕⓖⓗⓘⓙⓚⓛⓜⓝⓞⓟⓠⓡⓢⓣⓤⓥⓦⓧⓨⓩ',
-        5: '㊀㊁㊂㊃㊄㊅㊆㊇㊈㊉',
-    }
-    leveled_seq_no = defaultdict(int)
+_level2seq = {
+    2: '❶❷❸❹❺❻❼❽❾❿⓫⓬⓭⓮⓯⓰⓱⓲⓳⓴',
+    3: '①②③④⑤⑥⑦⑧⑨⑩⑪⑫⑬⑭⑮⑯⑰⑱⑲⑳',
+    4: '⓵⓶⓷⓸⓹⓺⓻⓼⓽⓾',
+    # 5: 'ⓐⓑⓒⓓⓔⓕⓖⓗⓘⓙⓚⓛⓜⓝⓞⓟⓠⓡⓢⓣⓤⓥⓦⓧⓨⓩ',
+    5: '㊀㊁㊂㊃㊄㊅㊆㊇㊈㊉',
+}
 
-    for line in lines:
+
+class TitleNumberer:
+    # 按顺序给标题编号，只依赖前面出现过的标题，所以可以一行一行地流式处理
+    def __init__(self):
+        self.leveled_seq_no = defaultdict(int)
+
+    def mark(self, line):
         if line.text_type != LineType.Title:
-            continue
+            return
 
         level = getattr(line, 'level', None)
         title = getattr(line, 'title', None)
         if not level or not title:
-            continue
+            return
 
         level = int(level)
-        leveled_seq_no[level] += 1
+        self.leveled_seq_no[level] += 1
         for i in range(level + 1, _max_level + 1):
-            leveled_seq_no[i] = 0
+            self.leveled_seq_no[i] = 0
 
         if level in (2, 3, 4, 5):
-            seq = leveled_seq_no[level]
+            seq = self.leveled_seq_no[level]
             if title in ("参考文献", "参考", "前言", "继续阅读", "习题", "本章概要"):
                 line.remain = f"{'#' * level} {title}"
-                continue
+                return
 
             seq_no = seq - 1
-            if seq_no < len(level2seq[level]):
-                line.remain = f"{'#' * level} {level2seq[level][seq_no]} {title.strip()}"
-                continue
+            if seq_no < len(_level2seq[level]):
+                line.remain = f"{'#' * level} {_level2seq[level][seq_no]} {title.strip()}"
+                return
 
         line.remain = f"{'#' * level} {title.strip()}"
 
 
+def remark_title_seq_no(lines):
+    numberer = TitleNumberer()
+    for line in lines:
+        numberer.mark(line)
+
+
 if __name__ == '__main__':
     # s = "![img](https://pic3.zhimg.com/80/v2-98fabeb9dd830221dc29b2f9e1ee1056_1440w.jpg)good"
     # r = parse_img(s)
@@ -1,9 +1,47 @@
-from typing import Iterable
+import re
+from typing import Iterable, List
+
+# 文法规则在字符串的位置上执行，rule.parse(text, pos) 返回所有可能的匹配结束位置，
+# 同一次解析里 (rule, pos) 的结果记在 memo 里只算一次，所以不会因为回溯变成指数复杂度。
+
+_max_literals = 64
+
+
+def _append_unique(ends, seen, end):
+    if end not in seen:
+        seen.add(end)
+        ends.append(end)
 
 
 class Rule:
     def execute(self, seq) -> Iterable[str]:
-        ...
+        for end in self.parse(seq):
+            yield seq[:end]
+
+    def parse(self, text, pos=0, memo=None) -> List[int]:
+        if memo is None:
+            memo = {}
+        key = (self, pos)
+        ends = memo.get(key)
+        if ends is None:
+            ends = memo[key] = self._ends(text, pos, memo)
+        return ends
+
+    def _ends(self, text, pos, memo) -> List[int]:
+        return []
+
+    def literals(self):
+        # 规则只能匹配有限个字面量时返回这些字面量，否则返回 None
+        return None
+
+    def compile(self):
+        lits = self.literals()
+        if lits is not None and len(lits) <= _max_literals:
+            return Regex(lits)
+        return self._compile_children()
+
+    def _compile_children(self):
+        return self
 
 
 class Text(Rule):
@@ -11,14 +49,42 @@ class Text(Rule):
         assert isinstance(text, str)
         self.text = text
 
-    def execute(self, seq) -> Iterable[str]:
-        if seq.startswith(self.text):
-            yield self.text
+    def _ends(self, text, pos, memo) -> List[int]:
+        if text.startswith(self.text, pos):
+            return [pos + len(self.text)]
+        return []
+
+    def literals(self):
+        return [self.text]
+
+    def compile(self):
+        return self
 
     def __repr__(self):
         return self.text
 
 
+class Regex(Rule):
+    # 由只包含字面量的规则编译而来：每个字面量一个前向断言分组，一次 match 得到全部结束位置
+    def __init__(self, literals):
+        self.texts = list(dict.fromkeys(literals))
+        self.pattern = re.compile(''.join(f'(?:(?=({re.escape(t)})))?' for t in self.texts))
+
+    def _ends(self, text, pos, memo) -> List[int]:
+        m = self.pattern.match(text, pos)
+        ends, seen = [], set()
+        for i, t in enumerate(self.texts, 1):
+            if m.start(i) >= 0:
+                _append_unique(ends, seen, pos + len(t))
+        return ends
+
+    def literals(self):
+        return list(self.texts)
+
+    def __repr__(self):
+        return f"Regex({self.pattern.pattern})"
+
+
 def _to_rule(rule):
     if isinstance(rule, Rule):
         return rule
@@ -35,12 +101,28 @@ class Or(Rule):
     def __init__(self, *rules):
         self.rules = _to_rules(*rules)
 
-    def execute(self, seq) -> Iterable[str]:
+    def _ends(self, text, pos, memo) -> List[int]:
+        if not self.rules:
+            return [pos]
+        ends, seen = [], set()
+        for r in self.rules:
+            for end in r.parse(text, pos, memo):
+                _append_unique(ends, seen, end)
+        return ends
+
+    def literals(self):
         if not self.rules:
-            yield ""
-        else:
-            for r in self.rules:
-                yield from r.execute(seq)
+            return ['']
+        lits = []
+        for r in self.rules:
+            sub = r.literals()
+            if sub is None:
+                return None
+            lits.extend(sub)
+        return list(dict.fromkeys(lits))
+
+    def _compile_children(self):
+        return Or(*(r.compile() for r in self.rules))
 
     def __repr__(self):
         return f"Or({','.join(str(r) for r in self.rules)})"
@@ -50,9 +132,20 @@ class Maybe(Rule):
     def __init__(self, rule):
         self.rule = _to_rule(rule)
 
-    def execute(self, seq) -> Iterable[str]:
-        yield ""
-        yield from self.rule.execute(seq)
+    def _ends(self, text, pos, memo) -> List[int]:
+        ends, seen = [pos], {pos}
+        for end in self.rule.parse(text, pos, memo):
+            _append_unique(ends, seen, end)
+        return ends
+
+    def literals(self):
+        sub = self.rule.literals()
+        if sub is None:
+            return None
+        return list(dict.fromkeys([''] + sub))
+
+    def _compile_children(self):
+        return Maybe(self.rule.compile())
 
     def __repr__(self):
         return f"Maybe({self.rule})"
@@ -62,35 +155,66 @@ class OneOrMore(Rule):
     def __init__(self, rule):
         self.rule = _to_rule(rule)
 
-    def execute(self, seq) -> Iterable[str]:
-        for m in self.rule.execute(seq):
-            yield m
-            if not m:
-                continue
-            yield from OneOrMore(self.rule).execute(seq[len(m):])
+    def _ends(self, text, pos, memo) -> List[int]:
+        # 深度优先地重复子规则，用栈代替递归，展开过的位置不再重复展开
+        ends, seen = [], set()
+        expanded = {pos}
+        stack = [(pos, iter(self.rule.parse(text, pos, memo)))]
+        while stack:
+            start, it = stack[-1]
+            for end in it:
+                _append_unique(ends, seen, end)
+                if end != start and end not in expanded:
+                    expanded.add(end)
+                    stack.append((end, iter(self.rule.parse(text, end, memo))))
+                    break
+            else:
+                stack.pop()
+        return ends
+
+    def _compile_children(self):
+        return OneOrMore(self.rule.compile())
 
     def __repr__(self):
         return f"OneOrMore({self.rule})"
 
+
 class Seq(Rule):
     def __init__(self, *rules):
         self.rules = _to_rules(*rules)
 
-    def execute(self, seq) -> Iterable[str]:
-        if not self.rules:
-            yield ""
-        else:
-            head = self.rules[0]
-            remain = self.rules[1:]
-            for m in head.execute(seq):
-                print(f"{head} match>", m)
-                for r in Seq(*remain).execute(seq[len(m):]):
-                    yield m + r
+    def _ends(self, text, pos, memo) -> List[int]:
+        ends = [pos]
+        for r in self.rules:
+            nexts, seen = [], set()
+            for start in ends:
+                for end in r.parse(text, start, memo):
+                    _append_unique(nexts, seen, end)
+            ends = nexts
+            if not ends:
+                break
+        return ends
+
+    def literals(self):
+        lits = ['']
+        for r in self.rules:
+            sub = r.literals()
+            if sub is None:
+                return None
+            lits = list(dict.fromkeys(a + b for a in lits for b in sub))
+            if len(lits) > _max_literals:
+                return None
+        return lits
+
+    def _compile_children(self):
+        return Seq(*(r.compile() for r in self.rules))
 
     def __repr__(self):
         return f"Seq({','.join(str(r) for r in self.rules)})"
 
-s = "abc"
-rule = Seq(OneOrMore(Or('a', 'b', 'c')), 'b')
-for s in rule.execute(s):
-    print(s)
+
+if __name__ == '__main__':
+    s = "abc"
+    rule = Seq(OneOrMore(Or('a', 'b', 'c')), 'b')
+    for s in rule.execute(s):
+        print(s)
@@ -0,0 +1,48 @@
+import time
+from collections import Counter
+
+import rewrite
+
+
+class Profile:
+    # 记录格式化各个阶段的耗时和调用次数，以及每条改写规则实际改变文本的次数。
+    # 不做 profile 时各个 format 函数拿到的是 None，不会有额外开销
+    def __init__(self, name=''):
+        self.name = name
+        self.times = Counter()
+        self.calls = Counter()
+        self.rule_hits = Counter()
+
+    def run(self, fn, *args, stage=None):
+        stage = stage or fn.__name__
+        old, rewrite.rule_hits = rewrite.rule_hits, self.rule_hits
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.times[stage] += time.perf_counter() - start
+            self.calls[stage] += 1
+            rewrite.rule_hits = old
+
+    def merge(self, other):
+        self.times.update(other.times)
+        self.calls.update(other.calls)
+        self.rule_hits.update(other.rule_hits)
+        return self
+
+    def report(self, rules=()):
+        # rules 是所有规则名，没有命中过的规则也列出来，方便找到失效的规则
+        lines = [f"== {self.name}", f"{'stage':<32} {'calls':>8} {'total ms':>10} {'us/call':>9}"]
+        for stage, t in self.times.most_common():
+            calls = self.calls[stage]
+            lines.append(f"{stage:<32} {calls:>8} {t * 1000:>10.2f} {t * 1e6 / calls:>9.1f}")
+        hits = Counter({name: 0 for name in rules})
+        hits.update(self.rule_hits)
+        if hits:
+            lines.append(f"{'rule':<32} {'hits':>8}")
+            for name, n in hits.most_common():
+                lines.append(f"{name:<32} {n:>8}")
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return f"Profile(name={self.name}, stages={len(self.times)}, rules={len(self.rule_hits)})"
@@ -0,0 +1,142 @@
+import re
+
+# 为 None 时不计数；设为 Counter 后，记录每条规则实际改变文本的次数，key 是规则名
+rule_hits = None
+
+_pattern_attrs = ('match', 'search', 'fullmatch', 'sub', 'subn', 'split', 'findall', 'finditer', 'scanner',
+                  'pattern', 'flags', 'groups', 'groupindex')
+
+
+class LazyPattern:
+    # 第一次用到时才编译的正则，模块导入时不付编译的开销。
+    # 编译后把 re.Pattern 的方法和属性放到实例上，之后的访问不再经过 __getattr__
+    def __init__(self, pattern, flags=0):
+        self._source = (pattern, flags)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        compiled = re.compile(*self._source)
+        for attr in _pattern_attrs:
+            setattr(self, attr, getattr(compiled, attr))
+        return getattr(compiled, name)
+
+    def __repr__(self):
+        return f"LazyPattern({self._source[0]!r})"
+
+
+class Rewriter:
+    # 把多条规则编译成一个交替正则，一次从左到右扫描完成所有替换。
+    # 每条规则是 (name, first, pattern, repl)：first 是匹配第一个字符的正则，
+    # 用来在扫描时快速跳过不可能命中的位置；repl 可以是字符串或者函数。
+    # 注意：规则的前后断言看到的是原始文本，而不是前面规则替换后的文本，
+    # 所以新加规则时要按"原始文本"来写，不能依赖其他规则的输出。
+    def __init__(self, *rules):
+        self.rules = []
+        self._regexps = []
+        self._pattern = None
+        self._repls = None
+        self._repl = None
+        for rule in rules:
+            self.add(*rule)
+
+    def add(self, name, first, pattern, repl):
+        self.rules.append((name, first, pattern, repl))
+        self._regexps.append(LazyPattern(pattern))
+        self._pattern = None
+        return self
+
+    def compile(self):
+        if self._pattern is not None:
+            return self._pattern
+        if not self.rules:
+            raise ValueError("nil rules")
+
+        firsts = '|'.join(first for _, first, _, _ in self.rules)
+        alts = '|'.join(f'(?P<_{i}>{p})' for i, (_, _, p, _) in enumerate(self.rules))
+        pattern = re.compile(f'(?={firsts})(?:{alts})')
+
+        repls = [None] * (pattern.groups + 1)
+        for i, (_, _, _, repl) in enumerate(self.rules):
+            repls[pattern.groupindex[f'_{i}']] = (i, repl)
+        self._repls = repls
+
+        # 所有规则的替换都是同一个常量时，直接交给 re 替换，省掉回调
+        consts = set(repl for _, _, _, repl in self.rules)
+        const = consts.pop() if len(consts) == 1 else None
+        if isinstance(const, str) and '\\' not in const:
+            self._repl = const
+        else:
+            self._repl = self._replace
+        self._pattern = pattern
+        return pattern
+
+    def _replace(self, m):
+        index, repl = self._repls[m.lastindex]
+        if callable(repl):
+            return repl(self._regexps[index].match(m.string, m.start()))
+        if '\\' in repl:
+            return self._regexps[index].match(m.string, m.start()).expand(repl)
+        return repl
+
+    def _count(self, m):
+        repl = self._repl(m) if callable(self._repl) else self._repl
+        if repl != m.group():
+            rule_hits[self.rules[self._repls[m.lastindex][0]][0]] += 1
+        return repl
+
+    def sub(self, text):
+        if rule_hits is not None:
+            return self.compile().sub(self._count, text)
+        return self.compile().sub(self._repl, text)
+
+    def __call__(self, text):
+        return self.sub(text)
+
+    def __repr__(self):
+        return f"Rewriter({','.join(name for name, _, _, _ in self.rules)})"
+
+
+class FixpointRewriter:
+    # 按顺序反复执行规则直到一整轮下来文本不再变化，结果和朴素的 while 循环一致。
+    # 每条规则是 (name, triggers, pattern, repl)，triggers 是能匹配时文本里必须出现的字面量。
+    # 一条规则上次执行后文本没变过，或者文本里缺少它的字面量，就可以跳过不执行。
+    def __init__(self, *rules):
+        self.rules = []
+        for rule in rules:
+            self.add(*rule)
+
+    def add(self, name, triggers, pattern, repl):
+        if isinstance(triggers, str):
+            triggers = (triggers,)
+        self.rules.append((name, tuple(triggers), LazyPattern(pattern), repl))
+        return self
+
+    def sub(self, text):
+        # version 在文本每次变化时加一，seen[i] 记录规则 i 最后一次检查时的版本
+        version = 0
+        seen = [-1] * len(self.rules)
+        while True:
+            old = text
+            for i, (name, triggers, pattern, repl) in enumerate(self.rules):
+                if seen[i] == version:
+                    continue
+                seen[i] = version
+                for t in triggers:
+                    if t not in text:
+                        break
+                else:
+                    new, n = pattern.subn(repl, text)
+                    if n and new != text:
+                        text = new
+                        version += 1
+                        if rule_hits is not None:
+                            rule_hits[name] += 1
+            if text == old:
+                return text
+
+    def __call__(self, text):
+        return self.sub(text)
+
+    def __repr__(self):
+        return f"FixpointRewriter({','.join(name for name, _, _, _ in self.rules)})"
@@ -9,6 +9,18 @@ class Segment:
     def format(self):
         pass
 
+    @classmethod
+    def expect(cls, text):
+        rs = cls.expect_at(text, 0)
+        if rs is None:
+            return None
+        seg, end = rs
+        return seg, text[end:]
+
+    @classmethod
+    def expect_at(cls, text, pos):
+        return None
+
     def __repr__(self):
         return f"{type(self).__name__}({self.text})"
 
@@ -21,11 +33,11 @@ class FormulaSeg(Segment):
         super().__init__(text)
 
     @classmethod
-    def expect(cls, text):
-        matcher = Matcher(text)
-        if not matcher.match_pair('$'):
+    def expect_at(cls, text, pos):
+        matcher = Matcher(text, pos)
+        if matcher.advance_pair('$') < 0:
             return None
-        return FormulaSeg(matcher.captured), matcher.remain
+        return FormulaSeg(matcher.captured), matcher.pos
 
     def format(self):
         from tex import regularize_formula
@@ -43,11 +55,11 @@ class CodeSeg(Segment):
         super().__init__(text)
 
     @classmethod
-    def expect(cls, text):
-        matcher = Matcher(text)
-        if not matcher.match_pair('`'):
+    def expect_at(cls, text, pos):
+        matcher = Matcher(text, pos)
+        if matcher.advance_pair('`') < 0:
             return None
-        return CodeSeg(matcher.captured), matcher.remain
+        return CodeSeg(matcher.captured), matcher.pos
 
 
 class TitleSeg(Segment):
@@ -67,23 +79,25 @@ class RefSeg(Segment):
         self.link = link
 
     @classmethod
-    def expect(cls, code):
-        matcher = Matcher(code)
-        if not matcher.match('['):
+    def expect_at(cls, code, pos):
+        matcher = Matcher(code, pos)
+        if matcher.advance('[') < 0:
             return None
 
-        m = matcher.match_util(']')
-        if not m:
+        start = matcher.pos
+        end = matcher.advance_util(']')
+        if end < 0:
             return None
-        caption = m[0][:-1]
-        if not matcher.match('('):
+        caption = code[start:end - 1]
+        if matcher.advance('(') < 0:
             return None
-        m = matcher.match_util(')')
-        if not m:
+        start = matcher.pos
+        end = matcher.advance_util(')')
+        if end < 0:
             return None
-        link = m[0][:-1]
+        link = code[start:end - 1]
         ref = RefSeg(matcher.captured, caption=caption, link=link)
-        return ref, matcher.remain
+        return ref, matcher.pos
 
 
 class TagSeg(Segment):
@@ -91,14 +105,12 @@ class TagSeg(Segment):
         super().__init__(text)
 
     @classmethod
-    def expect(cls, text):
-        from htmls import seek_html_tag
-        if text[:1] != '<':
-            return None
-        seg = seek_html_tag(text)
-        if not seg:
+    def expect_at(cls, text, pos):
+        from htmls import scan_html_tag
+        end = scan_html_tag(text, pos)
+        if end < 0:
             return None
-        return TagSeg(seg), text[len(seg):]
+        return TagSeg(text[pos:end]), end
 
 
 class ImgSeg(Segment):
@@ -111,32 +123,53 @@ class ImgSeg(Segment):
         return TagSeg(f'<img src="{self.link}" alt="{self.caption}" style="zoom:{100}%;"/>')
 
     @classmethod
-    def expect(cls, code):
-        matcher = Matcher(code)
-        if not matcher.match('!'):
+    def expect_at(cls, code, pos):
+        matcher = Matcher(code, pos)
+        if matcher.advance('!') < 0:
             return None
-        ref, remain = RefSeg.expect(matcher.remain)
+        rs = RefSeg.expect_at(code, matcher.pos)
+        if rs is None:
+            return None
+        ref, end = rs
         ref = ImgSeg('!' + ref.text, caption=ref.caption, link=ref.link)
-        return ref, remain
+        return ref, end
+
+
+# 各类片段的起始字符，反斜杠会转义它后面的一个字符
+_seg_types = {'$': FormulaSeg, '`': CodeSeg, '!': ImgSeg, '<': TagSeg, '[': RefSeg}
+_seg_delims = re.compile(r'[$`!<\[\\]')
+_seg_starts = re.compile(r'[$`!<\[]')
 
 
 def parse_to_segs(line: str) -> Iterable[Segment]:
-    text = []
-    while line:
-        rs = FormulaSeg.expect(line) or CodeSeg.expect(line) or ImgSeg.expect(line) or TagSeg.expect(
-            line) or RefSeg.expect(line)
-        if rs is not None:
-            if text:
-                yield TextSeg(''.join(text))
-                text = []
-            seg, line = rs
-            yield seg
-        else:
-            n_step = 2 if line[0] == '\\' else 1
-            text.append(line[:n_step])
-            line = line[n_step:]
-    if text:
-        yield TextSeg(''.join(text))
+    if not _seg_starts.search(line):
+        if line:
+            yield TextSeg(line)
+        return
+
+    start = pos = 0
+    while True:
+        m = _seg_delims.search(line, pos)
+        if not m:
+            break
+        pos = m.start()
+        c = line[pos]
+        if c == '\\':
+            pos += 2
+            continue
+
+        rs = _seg_types[c].expect_at(line, pos)
+        if rs is None:
+            pos += 1
+            continue
+        if start < pos:
+            yield TextSeg(line[start:pos])
+        seg, pos = rs
+        start = pos
+        yield seg
+
+    if start < len(line):
+        yield TextSeg(line[start:])
 
 
 def join_segs(*segs):
@@ -1,4 +1,8 @@
 import os
+import shutil
+
+from index import NoteIndex
+from walk import default_workers, walk
 
 note_dir = os.path.join(os.path.dirname(__file__), '..')
 
@@ -26,40 +30,60 @@ def abspath(*paths):
     return os.path.abspath(os.path.expanduser(os.path.join(*paths)))
 
 
+_note_index = None
+
+
+def note_index() -> NoteIndex:
+    # 第一次用到时加载并刷新一次，之后的查询直接用内存里的索引，不再遍历笔记树
+    global _note_index
+    if _note_index is None:
+        _note_index = NoteIndex(note_dir).load().refresh().save()
+    return _note_index
+
+
+def refresh_note_index() -> NoteIndex:
+    # 批量和常驻模式下每个文件刷新一次，看到前面的文件移动、链接造成的变化
+    if _note_index is None:
+        return note_index()
+    return _note_index.refresh().save()
+
+
 def seek_tag_dir(tag: str) -> str:
-    for root, sub_dirs, files in os.walk(note_dir):
-        for sub_dir in sub_dirs:
-            if sub_dir.lower() == tag.lower():
-                return abspath(root, sub_dir)
-    return abspath(note_dir, tag)
+    return note_index().seek_dir(tag) or abspath(note_dir, tag)
+
+
+def link_target(link, target=None):
+    # 相对路径的链接目标是相对于链接所在的目录，不是当前目录
+    if target is None:
+        target = os.readlink(link)
+    return abspath(os.path.dirname(abspath(link)), target)
 
 
 def is_broken_link(file):
     file = abspath(file)
     if not os.path.islink(file):
         return False
-    source = abspath(os.readlink(file))
-    return not os.path.exists(source)
+    return not os.path.exists(link_target(file))
 
 
-def find_the_latest_modified_markdown_file(directory):
+def find_the_latest_modified_markdown_file(directory, workers=default_workers):
     latest_file = None
     latest_mtime = 0
-    for root, sub_dirs, files in os.walk(directory):
-        for file in files:
-            if not file.endswith('.md'):
-                continue
-            path = abspath(root, file)
-            if os.path.islink(path):
-                if is_broken_link(path):
-                    print(f"remove broken link:{path}")
-                    os.unlink(path)
-                continue
-            mtime = os.path.getmtime(path)
-            if mtime <= latest_mtime:
-                continue
-            latest_file = path
-            latest_mtime = mtime
+    for entry in walk(abspath(directory), workers):
+        if entry.is_dir or not entry.name.endswith('.md'):
+            continue
+        path = entry.path
+        if entry.is_link:
+            if is_broken_link(path):
+                print(f"remove broken link:{path}")
+                os.unlink(path)
+            continue
+        mtime = entry.mtime
+        # 并发遍历的顺序不固定，mtime 相同时取路径最小的文件
+        if mtime < latest_mtime or (mtime == latest_mtime and (latest_mtime <= 0 or path >= latest_file)):
+            continue
+        latest_file = path
+        latest_mtime = mtime
     return latest_file
 
 
@@ -83,43 +107,127 @@ def read_file(path):
         return None
 
 
-def dump(path, lines: str):
+def fsync_dir(d):
+    # 让目录里新建、替换、删除的条目落盘
+    try:
+        fd = os.open(d, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class DirSync:
+    # 批量写文件时把目录的 fsync 攒起来，每个目录最后只做一次。不传 DirSync 时每次写完立即 fsync 目录
+    def __init__(self):
+        self.dirs = set()
+
+    def add(self, d):
+        self.dirs.add(d)
+
+    def flush(self):
+        for d in sorted(self.dirs):
+            fsync_dir(d)
+        self.dirs.clear()
+
+    def __repr__(self):
+        return f"DirSync(dirs={len(self.dirs)})"
+
+
+def _same_content(path, content):
+    # 磁盘上的内容和要写的内容是否一样，content 是字符串或者文本文件对象
+    try:
+        with open(path, 'r', newline='') as f:
+            if isinstance(content, str):
+                return f.read() == content
+            content.seek(0)
+            for chunk in iter(lambda: content.read(1 << 16), ''):
+                if f.read(len(chunk)) != chunk:
+                    return False
+            return f.read(1) == ''
+    except (OSError, UnicodeDecodeError):
+        return False
+    finally:
+        if not isinstance(content, str):
+            content.seek(0)
+
+
+def temp_path(path, suffix='.tmp'):
+    # 和 path 在同一个目录下的隐藏临时文件，同步工具和 watch 都不会把它当成笔记
+    d, name = os.path.split(path)
+    return os.path.join(d, f'.{name}.{os.getpid()}{suffix}')
+
+
+def write_file(path, content, syncer=None):
+    # 内容和磁盘上一样时不写，返回 False。否则先写同目录下的临时文件并 fsync，再 os.replace 过去，
+    # 中途崩溃时磁盘上要么是旧的笔记，要么是新的，不会是写了一半的。目录的 fsync 交给 syncer
+    path = os.path.realpath(path)
+    if _same_content(path, content):
+        return False
+
+    d = os.path.dirname(path)
+    tmp = temp_path(path)
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        try:
+            os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        with open(fd, 'w') as f:
+            if isinstance(content, str):
+                f.write(content)
+            else:
+                shutil.copyfileobj(content, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+    if syncer is None:
+        fsync_dir(d)
+    else:
+        syncer.add(d)
+    return True
+
+
+def dump(path, lines: str, syncer=None):
     ensure_dir_created(path)
-    with open(path, 'w') as f:
-        if isinstance(lines, (list, tuple)):
-            f.write('\n'.join(lines))
-        elif isinstance(lines, str):
-            f.write(lines)
-        else:
-            raise TypeError(f"invalid content type:{type(lines)}")
-        cwd = os.getcwd()
-        if path.startswith(cwd):
-            print(f"dump to {path[len(cwd) + 1:]}")
-        else:
-            print(f"dump to {path}")
-        return path
+    if isinstance(lines, (list, tuple)):
+        lines = '\n'.join(lines)
+    elif not isinstance(lines, str) and not hasattr(lines, 'read'):
+        raise TypeError(f"invalid content type:{type(lines)}")
+
+    written = write_file(path, lines, syncer)
+    cwd = os.getcwd()
+    shown = path[len(cwd) + 1:] if path.startswith(cwd) else path
+    print(f"dump to {shown}" if written else f"unchanged {shown}")
+    return path
 
 
 def seek_same_name_file(to_check):
     to_check = abspath(to_check)
     base_name = os.path.basename(to_check)
-    for root, sub_dirs, files in os.walk(note_dir):
-        for f in files:
-            if f != base_name:
-                continue
-            path = abspath(root, f)
-            if os.path.islink(path):
-                continue
-            if path == to_check:
-                continue
+    for path in note_index().seek_files(base_name):
+        if path != to_check:
             return path
     return None
 
 
-def release_to_tag_dirs(orig_file, content, tags):
+def release_to_tag_dirs(orig_file, content, tags, syncer=None):
+    # 笔记写到第一个标签目录，其余标签目录放指向它的符号链接。
+    # 已经在标签目录里并且内容没变的笔记、已经指向它的链接都不动；需要移动时先写好新的再删掉原来的
     if not tags:
         print("no tags found")
-        dump(orig_file, content)
+        dump(orig_file, content, syncer)
         return orig_file
 
     orig_file = abspath(orig_file)
@@ -140,19 +248,21 @@ def release_to_tag_dirs(orig_file, content, tags):
     to_dump = tags_files[0]
     to_links = tags_files[1:]
 
-    for root, sub_dirs, files in os.walk(note_dir):
-        for file in files:
-            path = abspath(root, file)
-            if not os.path.islink(path):
-                continue
-            source = abspath(os.readlink(path))
-            if not os.path.exists(source) or source == orig_file or source in tags_files:
-                print(f"unlink:{path}")
-                os.unlink(path)
+    for path, target in note_index().symlinks():
+        if os.path.isdir(path):
+            continue
+        source = link_target(path, target)
+        if source == to_dump and path in to_links and orig_file != path:
+            continue
+        if not os.path.exists(source) or source == orig_file or source in tags_files:
+            print(f"unlink:{path}")
+            os.unlink(path)
 
-    if os.path.exists(orig_file):
+    dump(to_dump, content, syncer)
+    if orig_file != to_dump and os.path.lexists(orig_file):
+        # 新的一份落盘之后才删除原来的文件
+        fsync_dir(os.path.dirname(to_dump))
         os.remove(orig_file)
-    dump(to_dump, content)
     for f in to_links:
         ensure_dir_created(f)
         if os.path.exists(f):
@@ -0,0 +1,161 @@
+import io
+import re
+import struct
+import threading
+import time
+import unittest
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import img
+
+
+def png_header(width, height):
+    return b'\x89PNG\r\n\x1a\n' + b'\x00\x00\x00\rIHDR' + struct.pack('>II', width, height) + b'\x00' * 64
+
+
+class ImageServer:
+    # 本地的图片服务：/png/<宽>x<高> 返回对应尺寸的 PNG 开头，/slow/... 先睡 slow 秒，files 里的路径返回对应的内容，
+    # 其余路径 404。ranges 为真时支持 Range 请求。记录每个路径的请求次数、发出的字节数和同时进行的请求数的最大值
+    def __init__(self, delay=0.0, slow=1.0, files=None, ranges=False):
+        self.delay = delay
+        self.slow = slow
+        self.files = files or {}
+        self.ranges = ranges
+        self.hits = Counter()
+        self.sent = Counter()
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with server._lock:
+                    server.hits[self.path] += 1
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                try:
+                    time.sleep(server.slow if self.path.startswith('/slow/') else server.delay)
+                    name = self.path.rsplit('/', 1)[-1]
+                    status = 200
+                    if self.path in server.files:
+                        body = server.files[self.path]
+                    elif self.path.startswith(('/png/', '/slow/')):
+                        body = png_header(*map(int, name.split('x')))
+                    else:
+                        body, status = b'not found', 404
+                    m = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+                    if status == 200 and server.ranges and m:
+                        start = int(m.group(1))
+                        end = int(m.group(2)) + 1 if m.group(2) else len(body)
+                        if start >= len(body):
+                            body, status = b'', 416
+                        else:
+                            body, status = body[start:end], 206
+                    self.send_response(status)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    with server._lock:
+                        server.sent[self.path] += len(body)
+                finally:
+                    with server._lock:
+                        server.active -= 1
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def url(self, path):
+        host, port = self.httpd.server_address
+        return f'http://{host}:{port}{path}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class CalcZoomRatiosTest(unittest.TestCase):
+    def test_dedupe(self):
+        with ImageServer() as server:
+            urls = [server.url('/png/200x50'), server.url('/png/50x50')] * 3
+            ratios = img.calc_zoom_ratios(urls, max_width=100)
+        self.assertEqual(ratios, {server.url('/png/200x50'): 50, server.url('/png/50x50'): 100})
+        self.assertEqual(server.hits, Counter({'/png/200x50': 1, '/png/50x50': 1}))
+
+    def test_per_host_limit(self):
+        with ImageServer(delay=0.05) as server:
+            urls = [server.url(f'/png/{i + 1}x1') for i in range(24)]
+            ratios = img.calc_zoom_ratios(urls, max_width=10, workers=16, per_host=3)
+        self.assertEqual(len(ratios), 24)
+        self.assertLessEqual(server.max_active, 3)
+        self.assertEqual(server.max_active, 3)
+
+    def test_pool_holds_per_host_connections(self):
+        # 连接池比 per_host 小时 urllib3 会丢弃连接并打出 "Connection pool is full" 的警告
+        with ImageServer(delay=0.05) as server:
+            urls = [server.url(f'/png/{i + 1}x1') for i in range(32)]
+            with self.assertNoLogs('urllib3', 'WARNING'):
+                img.calc_zoom_ratios(urls, workers=16, per_host=8)
+        self.assertEqual(server.max_active, 8)
+
+    def test_timeout(self):
+        with ImageServer(slow=2.0) as server:
+            start = time.perf_counter()
+            ratios = img.calc_zoom_ratios([server.url('/slow/400x400'), server.url('/png/400x400')],
+                                          max_width=100, timeout=(1, 0.2))
+            elapsed = time.perf_counter() - start
+        self.assertEqual(ratios, {server.url('/slow/400x400'): 100, server.url('/png/400x400'): 25})
+        self.assertLess(elapsed, 1.5)
+
+    def test_not_found(self):
+        with ImageServer() as server:
+            self.assertEqual(img.calc_zoom_ratios([server.url('/missing.png')], max_width=10),
+                             {server.url('/missing.png'): 100})
+            self.assertEqual(img.calc_zoom_ratio(server.url('/missing.png'), max_width=10), 100)
+
+
+def tiff_image(width, height):
+    # PIL 能读、image_size 解析不了的格式
+    from PIL import Image
+    f = io.BytesIO()
+    Image.new('RGB', (width, height)).save(f, 'TIFF')
+    return f.getvalue()
+
+
+class RemoteSizeTest(unittest.TestCase):
+    def test_no_range_downloads_once(self):
+        data = tiff_image(300, 20)
+        with ImageServer(files={'/a.tiff': data}) as server:
+            self.assertEqual(img.get_size_of_img(server.url('/a.tiff')), (300, 20))
+        self.assertEqual(server.hits['/a.tiff'], 1)
+        self.assertEqual(server.sent['/a.tiff'], len(data))
+
+    def test_range_reads_each_byte_once(self):
+        for width in (3, 300, 3000):
+            data = tiff_image(width, 20)
+            with ImageServer(files={'/a.tiff': data}, ranges=True) as server:
+                self.assertEqual(img.get_size_of_img(server.url('/a.tiff')), (width, 20))
+            self.assertEqual(server.sent['/a.tiff'], len(data))
+
+    def test_range_probe(self):
+        with ImageServer(ranges=True) as server:
+            self.assertEqual(img.get_size_of_img(server.url('/png/640x480')), (640, 480))
+        self.assertEqual(server.hits['/png/640x480'], 1)
+        self.assertLessEqual(server.sent['/png/640x480'], img._probe_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
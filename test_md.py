@@ -0,0 +1,26 @@
+import unittest
+
+from md import regular_char
+
+# 最初版本 regular_char 的替换表，兼容字符都写成转义
+baseline_chars = {
+    '\t': ' ', '\u3008': '\u27e8', '\u3009': '\u27e9', '\u2264': '\u2a7d', '\u2265': '\u2a7e',
+    '\u301e': '\u201d', '\u301d': '\u201c', '\uff08': '(', '\uff09': ')', '\uf97e': '\u91cf',
+    '\u2fa5': '\u91cc', '\u2faf': '\u9762', '\u2f64': '\u7528', '\u2f24': '\u5927', '\u2f7d': '\u800c',
+    '\u2f00': '\u4e00', '\u2f45': '\u65b9',
+}
+
+
+class RegularCharTest(unittest.TestCase):
+    def test_baseline_mappings(self):
+        for k, v in baseline_chars.items():
+            self.assertEqual(regular_char(k), v, hex(ord(k)))
+            self.assertEqual(regular_char(f'a{k}中{k}'), f'a{v}中{v}', hex(ord(k)))
+
+    def test_ascii_and_plain_text(self):
+        self.assertEqual(regular_char('a\tb'), 'a b')
+        self.assertEqual(regular_char('中文 text'), '中文 text')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,7 @@
 import string, re
 
+from rewrite import LazyPattern
+
 cmd2symbol = {
     'times': '×',
     'sigma': 'σ',
@@ -73,25 +75,47 @@ def is_punct(c):
     return c in string.punctuation
 
 
-def replace_tex_command(line, tab=cmd2symbol):
-    from itertools import takewhile
-    acc = []
-    while line:
-        prefix = ''.join(takewhile(lambda x: x != '\\', line))
-        acc.append(prefix)
-        line = line[len(prefix):]
-        if not line:
-            return ''.join(acc)
+class CommandTable:
+    # 把 命令->符号 的表编译成一个正则，一遍扫描完成替换。
+    # 和逐个字符扫描一样，反斜杠后面取尽可能长的字母作为命令名，
+    # 所以 \in、\infty、\int 不会互相误配；不认识的命令和转义字符原样保留。
+    # 连续的反斜杠从左往右两两成对转义，所以正则只需要匹配 "\\" 和认识的命令。
+    def __init__(self, tab):
+        self.tab = dict(tab)
+        names = sorted((c for c in self.tab if c and all(is_letter(x) for x in c)), key=len, reverse=True)
+        known = '|'.join(re.escape(c) for c in names) or '(?!)'
+        self.pattern = re.compile(rf'\\(?:\\|({known})(?![a-zA-Z]))')
+
+    def _replace(self, m):
+        cmd = m.group(1)
+        return m.group(0) if cmd is None else self.tab[cmd]
+
+    def sub(self, line):
+        if '\\' not in line:
+            return line
+        return self.pattern.sub(self._replace, line)
+
+
+_default_table = None
+
+
+def default_command_table():
+    # cmd2symbol 第一次用到时编译，之后一直复用；编译之后直接改 cmd2symbol 不会生效，要改表请用 register_tex_command
+    global _default_table
+    if _default_table is None:
+        _default_table = CommandTable(cmd2symbol)
+    return _default_table
+
+
+def register_tex_command(cmd, symbol):
+    global _default_table
+    cmd2symbol[cmd] = symbol
+    _default_table = None
+
 
-        cmd = ''.join(takewhile(is_letter, line[1:]))
-        symbol = tab.get(cmd)
-        length = max(2, len(cmd) + 1)
-        if symbol is None:
-            acc.append(line[:length])
-        else:
-            acc.append(symbol)
-        line = line[length:]
-    return ''.join(acc)
+def replace_tex_command(line, table=None):
+    # 其它的表先自己编译成 CommandTable 再传进来
+    return (table or default_command_table()).sub(line)
 
 
 def regularize_formula(text):
@@ -124,7 +148,7 @@ _to_formula_patterns = (
     r'[a-zA-Z]_[1-9ikj]',
     r"[a-zA-Z]_{[1-9ikj]}"
 )
-_new_formula_pattern = re.compile(_lookbehind + '(' + '|'.join(_to_formula_patterns) + ")" + _lookforward)
+_new_formula_pattern = LazyPattern(_lookbehind + '(' + '|'.join(_to_formula_patterns) + ")" + _lookforward)
 
 
 def detect_new_formula(text):
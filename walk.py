@@ -0,0 +1,67 @@
+import os
+from typing import NamedTuple
+
+default_workers = 8
+
+
+class Entry(NamedTuple):
+    root: str
+    name: str
+    path: str
+    is_dir: bool
+    is_link: bool
+    dir_entry: os.DirEntry
+
+    @property
+    def mtime(self):
+        # DirEntry 会缓存 stat 的结果，同一个条目多次取 mtime 只有一次系统调用
+        return self.dir_entry.stat().st_mtime
+
+
+def scan_dir(path):
+    # 列出一个目录，返回 (条目, 需要继续遍历的子目录)；和 os.walk 一样不进入指向目录的符号链接
+    entries = []
+    try:
+        with os.scandir(path) as it:
+            for e in it:
+                try:
+                    entries.append(Entry(path, e.name, e.path, e.is_dir(), e.is_symlink(), e))
+                except OSError:
+                    continue
+    except OSError:
+        return [], []
+    return entries, [e.path for e in entries if e.is_dir and not e.is_link]
+
+
+def walk_dirs(top, visit, workers=default_workers):
+    # 在线程池里并发执行 visit(key) -> (result, sub_keys)，按完成的顺序产出 (key, result)
+    if workers <= 1:
+        stack = [top]
+        while stack:
+            key = stack.pop()
+            result, sub_keys = visit(key)
+            stack.extend(reversed(list(sub_keys)))
+            yield key, result
+        return
+
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+    pool = ThreadPoolExecutor(max_workers=workers)
+    pending = {pool.submit(visit, top): top}
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                key = pending.pop(f)
+                result, sub_keys = f.result()
+                for k in sub_keys:
+                    pending[pool.submit(visit, k)] = k
+                yield key, result
+    finally:
+        for f in pending:
+            f.cancel()
+        pool.shutdown(wait=True)
+
+
+def walk(top, workers=default_workers):
+    for _, entries in walk_dirs(top, scan_dir, workers):
+        yield from entries
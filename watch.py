@@ -0,0 +1,200 @@
+import errno
+import os
+import select
+import struct
+import time
+
+from walk import default_workers, scan_dir, walk_dirs
+
+# inotify 的事件掩码，见 <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+_watch_mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_ONLYDIR
+_event = struct.Struct('iIII')
+_read_size = 1 << 16
+
+
+def _is_note(name):
+    return name.endswith('.md') and not name.startswith('.')
+
+
+def _scan_notes(top, workers=default_workers):
+    # 遍历 top 下的目录（跳过隐藏目录），产出 (目录, 条目列表)
+    def visit(path):
+        entries, sub_dirs = scan_dir(path)
+        return entries, [d for d in sub_dirs if not os.path.basename(d).startswith('.')]
+
+    yield from walk_dirs(top, visit, workers)
+
+
+class Inotify:
+    # libc inotify 接口的一个很小的 ctypes 封装，只支持本模块用到的部分
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise('inotify_init1')
+
+    def _raise(self, what, path=None):
+        import ctypes
+        err = ctypes.get_errno()
+        raise OSError(err, f"{what}: {os.strerror(err)}", path)
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise('inotify_add_watch', path)
+        return wd
+
+    def read(self, timeout=None):
+        # 等待最多 timeout 秒，产出 (wd, mask, name)
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return
+        try:
+            data = os.read(self.fd, _read_size)
+        except BlockingIOError:
+            return
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = _event.unpack_from(data, pos)
+            pos += _event.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            yield wd, mask, name
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class InotifyWatcher:
+    # 监听目录树里 markdown 文件的写入和移入。inotify 不递归，新建的目录要自己加监听
+    def __init__(self, roots):
+        self.roots = [os.path.abspath(r) for r in roots]
+        self.inotify = Inotify()
+        self._dirs = {}
+        try:
+            for root in self.roots:
+                self._watch_tree(root, strict=True)
+        except OSError:
+            self.inotify.close()
+            raise
+
+    def _watch_tree(self, top, strict=False):
+        # 给 top 下的每个目录加监听，返回已经存在的笔记，新目录在加上监听之前写入的文件也不会漏掉。
+        # strict 时监听数达到上限直接报错，让 watcher 退回轮询
+        found = []
+        for path, entries in _scan_notes(top):
+            try:
+                self._dirs[self.inotify.add_watch(path, _watch_mask)] = path
+            except OSError as e:
+                if strict and e.errno == errno.ENOSPC:
+                    raise
+                continue
+            found.extend(e.path for e in entries if not e.is_dir and not e.is_link and _is_note(e.name))
+        return found
+
+    def changes(self, timeout=None):
+        changed = set()
+        for wd, mask, name in self.inotify.read(timeout):
+            if mask & IN_Q_OVERFLOW:
+                # 事件队列溢出，丢了哪些事件不知道，重新加一遍监听并把所有笔记当作变化了
+                for root in self.roots:
+                    changed.update(self._watch_tree(root))
+                continue
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            d = self._dirs.get(wd)
+            if d is None or not name:
+                continue
+            path = os.path.join(d, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not name.startswith('.'):
+                    changed.update(self._watch_tree(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and _is_note(name) and not os.path.islink(path):
+                changed.add(path)
+        return changed
+
+    def close(self):
+        self.inotify.close()
+
+
+class PollWatcher:
+    # 没有 inotify 时的退路：每隔 interval 秒遍历一次，比较文件的 mtime 和大小
+    def __init__(self, roots, interval=0.5):
+        self.roots = [os.path.abspath(r) for r in roots]
+        self.interval = interval
+        self._stats = self._scan()
+
+    def _scan(self):
+        stats = {}
+        for root in self.roots:
+            for _, entries in _scan_notes(root):
+                for e in entries:
+                    if e.is_dir or e.is_link or not _is_note(e.name):
+                        continue
+                    try:
+                        st = e.dir_entry.stat()
+                    except OSError:
+                        continue
+                    stats[e.path] = (st.st_mtime_ns, st.st_size)
+        return stats
+
+    def changes(self, timeout=None):
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        stats = self._scan()
+        changed = {path for path, st in stats.items() if self._stats.get(path) != st}
+        self._stats = stats
+        return changed
+
+    def close(self):
+        pass
+
+
+def watcher(roots, interval=0.5):
+    # 优先用 inotify，不可用时（非 Linux、监听数超过上限等）退回轮询
+    try:
+        return InotifyWatcher(roots)
+    except (OSError, AttributeError):
+        return PollWatcher(roots, interval)
+
+
+class Debouncer:
+    # 编辑器保存时可能连续写好几次，一个文件安静了 delay 秒之后才交出去
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self._pending = {}
+
+    def add(self, paths, now=None):
+        now = time.monotonic() if now is None else now
+        for path in paths:
+            self._pending[path] = now
+
+    def ready(self, now=None):
+        now = time.monotonic() if now is None else now
+        paths = sorted(p for p, t in self._pending.items() if now - t >= self.delay)
+        for p in paths:
+            del self._pending[p]
+        return paths
+
+    def timeout(self, now=None):
+        # 距离最早一个文件可以交出去还要等多久，没有待处理的文件时返回 None
+        if not self._pending:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, min(self._pending.values()) + self.delay - now)
+
+    def __len__(self):
+        return len(self._pending)